@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import time
+import struct
+import threading
+import socketserver
+
+from bernhard import pb
+
+# 模拟数据源在每次采集时发出的探针事件， metric 为事件生成时的时间戳
+PROBE_SERVICE = "benchmark.probe"
+
+HEADER = struct.Struct("!I")
+
+
+class FakeRiemann(object):
+    """本地的 Riemann TCP 服务，解码每条消息并回复 ok ，统计收到的事件数和探针事件的端到端延迟。"""
+    def __init__(self, host="127.0.0.1", port=0):
+        self.lock = threading.Lock()
+        self.events = 0
+        self.messages = 0
+        self.latencies = []
+        self.services = {}
+
+        owner = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                owner.serve_connection(self.request)
+
+        self.server = socketserver.ThreadingTCPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.host, self.port = self.server.server_address
+        self.ack = pb.Msg(ok=True).SerializeToString()
+
+
+    def start(self):
+        thread = threading.Thread(target=self.server.serve_forever, name="FakeRiemann")
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+    def read_exactly(self, sock, size):
+        buf = b""
+        while len(buf) < size:
+            data = sock.recv(size - len(buf))
+            if not data:
+                return None
+            buf += data
+        return buf
+
+
+    def serve_connection(self, sock):
+        while True:
+            header = self.read_exactly(sock, HEADER.size)
+            if header is None:
+                return
+            raw = self.read_exactly(sock, HEADER.unpack(header)[0])
+            if raw is None:
+                return
+            received = time.time()
+            msg = pb.Msg.FromString(raw)
+            with self.lock:
+                self.messages += 1
+                self.events += len(msg.events)
+                for event in msg.events:
+                    self.services[event.service] = self.services.get(event.service, 0) + 1
+                    if event.service == PROBE_SERVICE:
+                        self.latencies.append(received - event.metric_d)
+            sock.sendall(HEADER.pack(len(self.ack)) + self.ack)
+
+
+    def snapshot(self):
+        """返回 (事件数, 消息数, 延迟样本数) ，用于截取一段测量区间。"""
+        with self.lock:
+            return self.events, self.messages, len(self.latencies)
@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+"""对完整的 combind_all_components 流水线做基准测试。
+
+数据库与操作系统由 benchmark.synthetic 中的模拟数据源代替，事件发往本地的 FakeRiemann 。
+结果（事件速率、端到端延迟、每个事件的 CPU 时间、内存）写为 JSON ，可用 --compare 与之前的结果对比。
+
+    python -m benchmark.run --duration 30 --output result.json
+"""
+
+import os
+import sys
+import json
+import time
+import signal
+import logging
+import argparse
+import functools
+import subprocess
+import configparser
+import multiprocessing
+
+import psutil
+
+from pg_metric_collect.core import combind_all_components
+from pg_metric_collect.postgresql_tool import PGAgent
+from pg_metric_collect.worker import PGMonitor
+from pg_metric_collect.worker import SysMonitor
+
+from benchmark.fake_riemann import FakeRiemann
+from benchmark.synthetic import SyntheticPGAgent
+from benchmark.synthetic import FakeOSInfo
+
+logger = logging.getLogger("pg_metric_collect")
+
+
+def parse_input():
+    parser = argparse.ArgumentParser(description="Benchmark the collector pipeline against synthetic sources.")
+    parser.add_argument("--conf", dest="config_filepath", type=str, required=False,
+                        help="Config file whose [queue], [riemann] batching, [schedule] etc. are used.")
+    parser.add_argument("--duration", type=float, default=30, help="Seconds to measure.")
+    parser.add_argument("--warmup", type=float, default=5, help="Seconds to run before measuring.")
+    parser.add_argument("--interval", type=float, default=1, help="Interval of metrics not in [schedule].")
+    parser.add_argument("--databases", type=int, default=4)
+    parser.add_argument("--backends", type=int, default=100)
+    parser.add_argument("--tables", type=int, default=200)
+    parser.add_argument("--statements", type=int, default=500)
+    parser.add_argument("--disks", type=int, default=4)
+    parser.add_argument("--replay", type=str, required=False,
+                        help="Replay a file recorded with record_file instead of the synthetic rows.")
+    parser.add_argument("--replay-speed", dest="replay_speed", type=float, default=0,
+                        help="1 replays at the recorded pace, 0 (default) as fast as the collector asks.")
+    parser.add_argument("--output", type=str, default="benchmark_result.json")
+    parser.add_argument("--compare", type=str, required=False, help="A previous result file to compare with.")
+    return parser.parse_args()
+
+
+def build_conf(args, riemann):
+    conf = configparser.ConfigParser()
+    if args.config_filepath:
+        conf.read(args.config_filepath)
+    for section in ("riemann", "postgresql", "schedule"):
+        if not conf.has_section(section):
+            conf.add_section(section)
+    conf.set("riemann", "tcp_host", riemann.host)
+    conf.set("riemann", "tcp_port", str(riemann.port))
+    conf.set("riemann", "host_tag", "benchmark")
+    # 所有路由都发往 FakeRiemann ，保留各自的 transport 等选项
+    for section in conf.sections():
+        if section == "riemann" or section.startswith("riemann:"):
+            for option in ("endpoints", "tcp_host", "tcp_port"):
+                if section != "riemann" or option == "endpoints":
+                    conf.remove_option(section, option)
+    conf.set("postgresql", "uri", "postgresql://benchmark@127.0.0.1/benchmark")
+    for section in conf.sections():
+        if section.startswith("postgresql:") or section == "spool":
+            conf.remove_section(section)
+    conf.remove_option("postgresql", "record_file")
+    conf.remove_option("postgresql", "replay_file")
+    if args.replay:
+        conf.set("postgresql", "replay_file", args.replay)
+        conf.set("postgresql", "replay_speed", str(args.replay_speed))
+    for name in PGMonitor.FULL_METRICS + PGMonitor.DB_METRICS + SysMonitor.METRICS:
+        if not conf.has_option("schedule", name):
+            conf.set("schedule", name, str(args.interval))
+    return conf
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def process_tree(pid):
+    try:
+        root = psutil.Process(pid)
+        return [root] + root.children(recursive=True)
+    except psutil.NoSuchProcess:
+        return []
+
+
+def cpu_seconds(processes):
+    total = 0.0
+    for p in processes:
+        try:
+            times = p.cpu_times()
+            total += times.user + times.system
+        except psutil.NoSuchProcess:
+            pass
+    return total
+
+
+def rss_bytes(processes):
+    rss = {}
+    for p in processes:
+        try:
+            rss[p.pid] = p.memory_info().rss
+        except psutil.NoSuchProcess:
+            pass
+    return rss
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * q / 100.0), len(values) - 1)]
+
+
+def run(args):
+    riemann = FakeRiemann().start()
+    conf = build_conf(args, riemann)
+    cardinality = {"databases": args.databases,
+                   "backends": args.backends,
+                   "tables": args.tables,
+                   "statements": args.statements}
+    if args.replay:
+        pg_agent_class = PGAgent
+    else:
+        pg_agent_class = functools.partial(SyntheticPGAgent, cardinality=cardinality)
+    collector = multiprocessing.Process(target=combind_all_components,
+                                        args=({"nosys": False, "noalldb": False}, conf),
+                                        kwargs={"pg_agent_class": pg_agent_class,
+                                                "os_info_class": functools.partial(FakeOSInfo, disks=args.disks)},
+                                        name="Collector")
+    collector.start()
+    time.sleep(args.warmup)
+
+    processes = process_tree(collector.pid)
+    events_before, messages_before, probes_before = riemann.snapshot()
+    cpu_before = cpu_seconds(processes)
+    started = time.time()
+    peak_rss = {}
+    while time.time() - started < args.duration:
+        for pid, rss in rss_bytes(processes).items():
+            peak_rss[pid] = max(peak_rss.get(pid, 0), rss)
+        time.sleep(0.5)
+    elapsed = time.time() - started
+    cpu_used = cpu_seconds(processes) - cpu_before
+    events_after, messages_after, probes_after = riemann.snapshot()
+
+    os.kill(collector.pid, signal.SIGTERM)
+    collector.join()
+    riemann.stop()
+
+    events = events_after - events_before
+    latencies = riemann.latencies[probes_before:probes_after]
+    return {"commit": git_commit(),
+            "timestamp": int(time.time()),
+            "python": sys.version.split()[0],
+            "cardinality": dict(cardinality, disks=args.disks),
+            "replay": args.replay,
+            "interval": args.interval,
+            "config": args.config_filepath,
+            "duration": elapsed,
+            "events": events,
+            "messages": messages_after - messages_before,
+            "events_per_second": events / elapsed,
+            "latency_ms": dict((name, percentile(latencies, q) * 1000 if latencies else None)
+                               for name, q in (("p50", 50), ("p90", 90), ("p99", 99), ("max", 100))),
+            "latency_samples": len(latencies),
+            "cpu_seconds": cpu_used,
+            "cpu_us_per_event": cpu_used / events * 1000000 if events else None,
+            "rss_mb_total": sum(peak_rss.values()) / float(1 << 20),
+            "rss_mb_max_process": max(peak_rss.values()) / float(1 << 20) if peak_rss else None}
+
+
+def compare(result, previous):
+    for key in ("events_per_second", "cpu_us_per_event", "rss_mb_total"):
+        old, new = previous.get(key), result.get(key)
+        if old and new is not None:
+            print("{:<20} {:>12.2f} -> {:>12.2f} ({:+.1f}%)".format(key, old, new, (new - old) * 100.0 / old))
+    for name in ("p50", "p99"):
+        old, new = previous["latency_ms"].get(name), result["latency_ms"].get(name)
+        if old and new is not None:
+            print("{:<20} {:>12.2f} -> {:>12.2f} ({:+.1f}%)".format("latency_ms." + name, old, new,
+                                                                   (new - old) * 100.0 / old))
+
+
+def main():
+    args = parse_input()
+    logger.setLevel(logging.WARN)
+    result = run(args)
+    with open(args.output, "w") as f:
+        json.dump(result, f, indent=2, sort_keys=True)
+    print(json.dumps(result, indent=2, sort_keys=True))
+    if args.compare:
+        with open(args.compare) as f:
+            compare(result, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import time
+import random
+import logging
+
+from pg_metric_collect.event import Event
+from pg_metric_collect.os_tool import OSInfo
+from pg_metric_collect.postgresql_tool import PGAgent
+from pg_metric_collect.postgresql_tool import QueryResult
+from pg_metric_collect.recorder import row_type
+
+from benchmark.fake_riemann import PROBE_SERVICE
+
+logger = logging.getLogger("pg_metric_collect")
+
+STATES = ("active", "idle", "idle", "idle in transaction")
+DATABASE_OID = 16384
+QUERY_HEADS = ("SELECT * FROM t WHERE id = $1", "select count(*) FROM t", "UPDATE t SET v = $1 WHERE id = $2",
+               "INSERT INTO t VALUES ($1, $2)", "DELETE FROM t WHERE id = $1", "COPY t FROM STDIN")
+USER_OID = 10
+RELATION_OID = 100000
+
+
+SessionRow = row_type(("ts", "max_conns", "datname", "usename", "pid", "state", "waiting", "user_query",
+                       "backend_age", "xact_age", "query_age", "state_age"))
+StatementRow = row_type(("dbid", "userid", "queryid", "calls", "total_time", "rows", "blks_read", "blks_written",
+                         "shared_dirtied", "local_dirtied", "shared_written", "local_written"))
+
+
+class SyntheticBackend(object):
+    """按给定的数据库、会话、表、语句数量生成一份系统视图的行，每次查询时按这份数据返回，累计值随时间增长。
+
+    按 SQL 中引用的系统视图分派，不认识的 SQL 返回空结果。
+    """
+    def __init__(self, databases=4, backends=100, tables=200, statements=500, seed=0):
+        rand = random.Random(seed)
+        self.started = time.time() - 86400
+        self.dbnames = ["bench_db{:03d}".format(i) for i in range(databases)]
+        usenames = self.usenames = ["user{:02d}".format(i) for i in range(10)]
+        self.sessions = []
+        for pid in range(backends):
+            state = rand.choice(STATES)
+            self.sessions.append(SessionRow(0, 1000.0, rand.choice(self.dbnames), rand.choice(usenames),
+                                            10000 + pid, state, rand.random() < 0.05, True,
+                                            rand.uniform(0, 3600), rand.uniform(0, 10), rand.uniform(0, 10),
+                                            rand.uniform(0, 10)))
+        self.schemas = ["schema{:02d}".format(i) for i in range(max(tables // 50, 1))]
+        self.relations = [(RELATION_OID + i, rand.expovariate(1 / 20.0)) for i in range(tables)]
+        # (dbid, userid, queryid, 每秒调用次数, 平均耗时, 语句开头)
+        self.statements = [(DATABASE_OID + rand.randrange(databases), USER_OID + rand.randrange(len(usenames)),
+                            rand.getrandbits(62), rand.expovariate(1 / 10.0), rand.expovariate(1 / 50.0),
+                            rand.choice(QUERY_HEADS))
+                           for _ in range(statements)]
+        self.rates = dict((dbname, rand.uniform(10, 1000)) for dbname in self.dbnames)
+        self.unknown = set()
+        self.handlers = [("pg_stat_activity", self.session_snapshot),
+                         ("showtext := true", self.statement_texts),
+                         ("showtext := false", self.statement_counters),
+                         ("server_version_num", self.server_version),
+                         ("oid, datname", self.database_oids),
+                         ("SELECT oid FROM pg_database", self.current_database_oid),
+                         ("pg_roles", self.user_oids),
+                         ("pg_database_size", self.database_size),
+                         ("relpages", self.relpages_size),
+                         ("xact_commit", self.transactions),
+                         ("SUM(deadlocks)", self.deadlocks),
+                         ("tup_deleted", self.udi_rows),
+                         ("pg_statio_user_indexes", self.hit_ratio),
+                         ("pg_statio_user_tables", self.hit_ratio),
+                         ("pg_statio_all_tables", self.relation_counters),
+                         ("nspname", self.relation_names),
+                         ("pg_stat_all_tables", self.seq_idx_scan),
+                         ("FROM pg_database", self.databases),
+                         ("current_database()", self.current_database),
+                         ("pg_last_xact_replay_timestamp", self.replication_lag)]
+
+
+    def execute(self, sql_str, params=None, database=None):
+        for marker, handler in self.handlers:
+            if marker in sql_str:
+                return QueryResult(handler())
+        if sql_str not in self.unknown:
+            self.unknown.add(sql_str)
+            logger.warn("Synthetic backend has no rows for SQL: {}".format(" ".join(sql_str.split())))
+        return QueryResult([])
+
+
+    def counter(self, rate, now):
+        return int((now - self.started) * rate)
+
+
+    def session_snapshot(self):
+        rows = list(self.sessions)
+        if rows:
+            rows[0] = rows[0]._replace(ts=int(time.time()))
+        return rows
+
+
+    def statement_counters(self):
+        now = time.time()
+        rows = []
+        for dbid, userid, queryid, rate, mean_time, _ in self.statements:
+            calls = self.counter(rate, now)
+            rows.append(StatementRow(dbid, userid, queryid, calls, calls * mean_time, calls * 10, calls * 3,
+                                     calls // 10, calls // 20, 0, calls // 10, 0))
+        return rows
+
+
+    def statement_texts(self):
+        return [(s[2], s[5]) for s in self.statements]
+
+
+    def server_version(self):
+        return [(160000,)]
+
+
+    def database_oids(self):
+        return [(DATABASE_OID + i, dbname) for i, dbname in enumerate(self.dbnames)]
+
+
+    def current_database_oid(self):
+        return [(DATABASE_OID,)]
+
+
+    def user_oids(self):
+        return [(USER_OID + i, usename) for i, usename in enumerate(self.usenames)]
+
+
+    def database_size(self):
+        now = time.time()
+        return [(dbname, self.counter(self.rates[dbname], now)) for dbname in self.dbnames]
+
+
+    def relpages_size(self):
+        now = time.time()
+        return [(self.counter(self.rates[self.dbnames[0]], now),)]
+
+
+    def transactions(self):
+        now = time.time()
+        return [(dbname, now, self.counter(self.rates[dbname], now), self.started, None)
+                for dbname in self.dbnames]
+
+
+    def deadlocks(self):
+        return [(0,)]
+
+
+    def udi_rows(self):
+        now = time.time()
+        return [(dbname, self.counter(self.rates[dbname] / 10, now), self.counter(self.rates[dbname] / 3, now),
+                 self.counter(self.rates[dbname] / 2, now))
+                for dbname in self.dbnames]
+
+
+    def relation_counters(self):
+        now = time.time()
+        rows = []
+        for i, (relid, rate) in enumerate(self.relations):
+            # 一部分表没有活动，计数器不变
+            if i % 4 == 0:
+                rate = 0
+            rows.append((relid,) + tuple(self.counter(rate * k, now) for k in range(1, 12)))
+        return rows
+
+
+    def relation_names(self):
+        return [(relid, "{}.table{}".format(self.schemas[i % len(self.schemas)], i))
+                for i, (relid, _) in enumerate(self.relations)]
+
+
+    def hit_ratio(self):
+        return [(0.99,)]
+
+
+    def seq_idx_scan(self):
+        now = time.time()
+        return [(schema, self.counter(50, now), self.counter(5000, now)) for schema in self.schemas]
+
+
+    def databases(self):
+        return [(dbname,) for dbname in self.dbnames]
+
+
+    def current_database(self):
+        return [(self.dbnames[0] if self.dbnames else "bench",)]
+
+
+    def replication_lag(self):
+        return [(0.0,)]
+
+
+class SyntheticPGAgent(PGAgent):
+    """不连接数据库，查询结果来自 SyntheticBackend 的 PGAgent ，各数据库共用同一份数据。"""
+    def __init__(self, uri, cardinality=None, **kwargs):
+        # load_pg_agents 总会传入 backend （未配置 replay_file 时为 None）
+        if kwargs.get("backend") is None:
+            kwargs["backend"] = SyntheticBackend(**(cardinality or {}))
+        super(SyntheticPGAgent, self).__init__(uri, **kwargs)
+
+
+class FakeOSInfo(OSInfo):
+    """不读取系统信息的 OSInfo ，磁盘数量可配置，每个指标附带一个探针事件用于测量端到端延迟。"""
+    def __init__(self, disks=4, **kwargs):
+        self.sampler = None
+        self.disks = ["/dev/bench{}".format(i) for i in range(disks)]
+        self.mount_points = ["/bench{}".format(i) for i in range(disks)]
+
+
+    def _with_probe(self, events):
+        now = time.time()
+        events.append(Event(service=PROBE_SERVICE, time=int(now), metric=now))
+        return events
+
+
+    def _series(self, services, tags, value):
+        the_time = int(time.time())
+        return [Event(service=service, tags=tags, time=the_time, metric=value) for service in services]
+
+
+    def metric_boot_time(self):
+        return self._with_probe(self._series(["boot_time"], [], time.time() - 86400))
+
+
+    def metric_average_load(self):
+        return self._with_probe(self._series(["1min", "5min", "15min"], ["avg_load"], 1.0))
+
+
+    def metric_cpu_cores(self):
+        return self._with_probe(self._series(["cpu_cores"], [], 8))
+
+
+    def metric_cpu_percent(self):
+        return self._with_probe(self._series(["user", "system", "idle", "iowait"], ["cpu_percent"], 25.0))
+
+
+    def metric_memory(self):
+        return self._with_probe(self._series(["memory_total", "memory_available", "memory_used", "memory_free",
+                                              "memory_percent"], ["memory_info"], 1 << 30))
+
+
+    def metric_disk_usage(self, mount_points=None):
+        rtn = []
+        for mount_point in self.mount_points:
+            rtn.extend(self._series(["disk_total", "disk_used", "disk_free", "disk_percent"],
+                                    ["disk_info", mount_point], 1 << 30))
+        return self._with_probe(rtn)
+
+
+    def metric_disk_io(self):
+        rtn = []
+        for dev_path in self.disks:
+            rtn.extend(self._series(["read_bytes", "write_bytes", "read_time", "write_time"],
+                                    ["disk_io", dev_path], time.time()))
+        return self._with_probe(rtn)
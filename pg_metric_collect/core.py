@@ -1,6 +1,8 @@
 #!/usr/bin/env python
 # coding=utf-8
 
+import os
+import re
 import sys
 import logging
 import argparse
@@ -11,10 +13,24 @@ import traceback
 
 from pg_metric_collect.postgresql_tool import PGAgent
 from pg_metric_collect.riemann_tool import EventAgent
+from pg_metric_collect.riemann_tool import EndpointGroup
+from pg_metric_collect.riemann_tool import make_transport
+from pg_metric_collect.riemann_tool import UDP_MAX_SIZE
+from pg_metric_collect.spool import EventSpool
+from pg_metric_collect.event_queue import EventQueue
+from pg_metric_collect.instrument import Instruments
+from pg_metric_collect.instrument import Profiled
+from pg_metric_collect.recorder import QueryRecorder
+from pg_metric_collect.recorder import ReplayBackend
 from pg_metric_collect.os_tool import OSInfo
+from pg_metric_collect.pipeline import DedupStage
+from pg_metric_collect.pipeline import WindowStage
+from pg_metric_collect.prometheus_tool import MetricSnapshot
+from pg_metric_collect.prometheus_tool import PrometheusExporter
 from pg_metric_collect.worker import Sender
 from pg_metric_collect.worker import PGMonitor
 from pg_metric_collect.worker import SysMonitor
+from pg_metric_collect.worker import DEFAULT_INTERVALS
 
 
 logFormatter = logging.Formatter('%(asctime)s [%(levelname)s] (%(pathname)s:%(lineno)d@%(funcName)s) -> %(message)s')
@@ -24,6 +40,8 @@ consoleHandler.setFormatter(logFormatter)
 logger.addHandler(consoleHandler)
 logger.setLevel(logging.INFO)
 
+SHUTDOWN_TIMEOUT = 10
+
 
 def parse_input():
     parser = argparse.ArgumentParser(description="PostgreSQL host information collector.")
@@ -34,6 +52,8 @@ def parse_input():
                         help="Do not collect information of OS.")
     parser.add_argument("--noalldb", dest="noalldb", action='store_true', required=False,
                         help="Do not collect general information of all databases.")
+    parser.add_argument("--profile", dest="profile_dir", type=str, nargs="?", const=".", required=False,
+                        help="Run every process under cProfile and write the stats to this directory on exit.")
 
     if len(sys.argv) == 1:
         parser.print_help()
@@ -51,29 +71,208 @@ def load_conf(conf_path):
 
 def killall(signum, frame):
     logger.info("Kill all workers ... ...")
-    for child in multiprocessing.active_children():
+    children = multiprocessing.active_children()
+    senders = [c for c in children if c.name == Sender.__name__]
+    monitors = [c for c in children if c.name != Sender.__name__]
+    # 先停止采集进程，再让 Sender 把队列中剩余的事件发送完毕
+    for child in monitors:
+        child.terminate()
+    for child in monitors:
+        child.join()
+    for child in senders:
         child.terminate()
+    for child in senders:
+        child.join(SHUTDOWN_TIMEOUT)
+        if child.is_alive():
+            logger.warn("Sender did not flush in {} seconds, kill it.".format(SHUTDOWN_TIMEOUT))
+            os.kill(child.pid, signal.SIGKILL)
+
+
+def load_per_metric(conf, section):
+    values = {}
+    if conf.has_section(section):
+        for name in conf.options(section):
+            values[name] = conf.getfloat(section, name)
+    return values
+
+
+def load_pg_agents(conf, agent_class=PGAgent):
+    """[postgresql] 以及每个 [postgresql:名称] 段各是一个实例，后者未设置的选项取自 [postgresql] 。"""
+    sections = [sec for sec in conf.sections() if sec.startswith("postgresql:")]
+    if conf.has_option("postgresql", "uri"):
+        sections.insert(0, "postgresql")
+
+    agents = []
+    for section in sections:
+        def option(getter, name, fallback=None):
+            if conf.has_option(section, name):
+                return getter(section, name)
+            return getter("postgresql", name, fallback=fallback)
+
+        default_host = section.split(":", 1)[1] if ":" in section else None
+        # 录制与回放文件只属于各自的段，不从 [postgresql] 继承
+        recorder = None
+        if conf.has_option(section, "record_file"):
+            recorder = QueryRecorder(conf.get(section, "record_file"),
+                                     max_bytes=option(conf.getint, "record_max_mb", 1024) << 20)
+        backend = None
+        if conf.has_option(section, "replay_file"):
+            backend = ReplayBackend(conf.get(section, "replay_file"),
+                                    speed=option(conf.getfloat, "replay_speed", 1.0))
+        agents.append(agent_class(conf.get(section, "uri"),
+                                  pool_size=option(conf.getint, "pool_size", 10),
+                                  session=option(conf.getboolean, "session", False),
+                                  statement_timeout=option(conf.getint, "statement_timeout_ms"),
+                                  application_name=option(conf.get, "application_name", "pg_metric_collect"),
+                                  host_tag=conf.get(section, "host_tag", fallback=default_host),
+                                  retry_interval=option(conf.getint, "retry_interval", 30),
+                                  connect_timeout=option(conf.getint, "connect_timeout", 10),
+                                  all_databases=option(conf.getboolean, "all_databases", False),
+                                  max_db_connections=option(conf.getint, "max_db_connections", 10),
+                                  db_idle_timeout=option(conf.getint, "db_idle_timeout", 300),
+                                  dbs_per_cycle=option(conf.getint, "dbs_per_cycle"),
+                                  recorder=recorder,
+                                  backend=backend,
+                                  statements_top_n=option(conf.getint, "statements_top_n", 10),
+                                  statements_max_entries=option(conf.getint, "statements_max_entries", 20000),
+                                  size_mode=option(conf.get, "size_mode", "walk"),
+                                  size_refresh_interval=option(conf.getfloat, "size_refresh_interval", 300),
+                                  size_dbs_per_cycle=option(conf.getint, "size_dbs_per_cycle"),
+                                  relation_stats_batch=option(conf.getint, "relation_stats_batch", 1000),
+                                  relation_stats_top_n=option(conf.getint, "relation_stats_top_n", 50),
+                                  relation_stats_max_entries=option(conf.getint, "relation_stats_max_entries",
+                                                                    200000)))
+    return agents
+
+
+def load_os_options(conf):
+    options = {"sampler": conf.get("os", "sampler", fallback="proc"),
+               "devices": conf.get("os", "devices", fallback=None) or None}
+    if conf.has_option("os", "exclude_devices"):
+        options["exclude_devices"] = conf.get("os", "exclude_devices") or None
+    return options
+
+
+def load_stages(conf):
+    """每个采集进程各自的一组处理环节。"""
+    stages = []
+    if conf.get("window", "services", fallback=None):
+        stages.append(WindowStage(conf.get("window", "services"),
+                                  window=conf.getfloat("window", "window", fallback=10),
+                                  samples=conf.getint("window", "samples", fallback=64),
+                                  max_series=conf.getint("window", "max_series", fallback=10000)))
+    if conf.get("dedup", "services", fallback=None):
+        stages.append(DedupStage(conf.get("dedup", "services"),
+                                 heartbeat=conf.getfloat("dedup", "heartbeat", fallback=300),
+                                 epsilon=conf.getfloat("dedup", "epsilon", fallback=0.0),
+                                 ttl=conf.getfloat("dedup", "ttl", fallback=None)))
+    return stages
+
+
+def load_riemann_group(conf, section):
+    """[riemann:名称] 段未设置的选项取自 [riemann] 。"""
+    def option(getter, name, fallback=None):
+        if conf.has_option(section, name):
+            return getter(section, name)
+        return getter("riemann", name, fallback=fallback)
+
+    endpoints = option(conf.get, "endpoints")
+    if endpoints:
+        addresses = [e.strip().rsplit(":", 1) for e in endpoints.split(",") if e.strip()]
+    else:
+        addresses = [(option(conf.get, "tcp_host"), option(conf.get, "tcp_port"))]
+    kind = option(conf.get, "transport", "tcp")
+    transports = [make_transport(kind, host, port,
+                                 retry_interval=option(conf.getint, "retry_interval", 5),
+                                 max_in_flight=option(conf.getint, "max_in_flight", 8),
+                                 max_size=option(conf.getint, "udp_max_size", UDP_MAX_SIZE))
+                  for host, port in addresses]
+    return EndpointGroup(transports, mode=option(conf.get, "mode", "failover"))
+
+
+def load_riemann_routes(conf):
+    """返回默认的地址组，以及按各 [riemann:名称] 段的 services 正则选择的地址组。"""
+    routes = []
+    for section in conf.sections():
+        if section.startswith("riemann:"):
+            routes.append((re.compile(conf.get(section, "services")), load_riemann_group(conf, section)))
+    return load_riemann_group(conf, "riemann"), routes
+
+
+def load_exporter(conf):
+    port = conf.getint("prometheus", "port", fallback=0)
+    if not port:
+        return None
+    # 默认让每个序列至少跨过两次最长的采集间隔，例如每小时一次的 boot_time
+    intervals = dict(DEFAULT_INTERVALS)
+    intervals.update(load_per_metric(conf, "schedule"))
+    expire = conf.getfloat("prometheus", "expire", fallback=max([300] + [i * 2 for i in intervals.values()]))
+    if expire < max(intervals.values()):
+        logger.warn("[prometheus] expire {}s is shorter than the longest schedule interval {}s, "
+                    "some series will be missing from /metrics.".format(expire, max(intervals.values())))
+    snapshot = MetricSnapshot(prefix=conf.get("prometheus", "prefix", fallback="pg_metric_collect"),
+                              default_host=conf.get("riemann", "host_tag", fallback=None),
+                              expire=expire)
+    return PrometheusExporter(port, bind=conf.get("prometheus", "bind", fallback="0.0.0.0"), snapshot=snapshot)
 
 
-def combind_all_components(cmd_args , conf):
+def combind_all_components(cmd_args , conf, pg_agent_class=PGAgent, os_info_class=OSInfo):
+    """pg_agent_class 、 os_info_class 可以替换为其它实现，例如 benchmark 中的模拟数据源。"""
     try:
-        component_agent_map = [(Sender, EventAgent(conf.get("riemann", "tcp_host"),
-                                                   conf.get("riemann", "tcp_port"),
-                                                   conf.get("riemann", "host_tag")), None)]
+        intervals = load_per_metric(conf, "schedule")
+        telemetry_interval = conf.getfloat("queue", "telemetry_interval", fallback=10)
+        instrument_interval = conf.getfloat("instrument", "interval", fallback=60)
+        spool = None
+        if conf.has_option("spool", "directory"):
+            spool = EventSpool(conf.get("spool", "directory"),
+                               segment_size=conf.getint("spool", "segment_size_mb", fallback=16) << 20,
+                               max_bytes=conf.getint("spool", "max_size_mb", fallback=1024) << 20)
+        transport, routes = load_riemann_routes(conf)
+        component_agent_map = [(Sender, EventAgent(conf.get("riemann", "tcp_host", fallback=None),
+                                                   conf.get("riemann", "tcp_port", fallback=None),
+                                                   conf.get("riemann", "host_tag"),
+                                                   spool=spool,
+                                                   replay_rate=conf.getint("spool", "replay_rate", fallback=1000),
+                                                   instruments=Instruments(instrument_interval),
+                                                   transport=transport,
+                                                   routes=routes),
+                                {"batch_size": conf.getint("riemann", "batch_size", fallback=1),
+                                 "batch_linger": conf.getint("riemann", "batch_linger_ms", fallback=0) / 1000.0,
+                                 "max_latency": conf.getint("riemann", "max_latency_ms", fallback=1000) / 1000.0,
+                                 "exporter": load_exporter(conf)})]
         if not cmd_args["nosys"]:
-            component_agent_map.append((SysMonitor, OSInfo(), None))
+            component_agent_map.append((SysMonitor, [os_info_class(**load_os_options(conf))], {"intervals": intervals,
+                                                                 "telemetry_interval": telemetry_interval,
+                                                                 "instrument_interval": instrument_interval,
+                                                                 "stages": load_stages(conf)}))
 
-        if not cmd_args["noalldb"]:
-            component_agent_map.append((PGMonitor, PGAgent(conf.get("postgresql", "uri")), True))
-        else:
-            component_agent_map.append((PGMonitor, PGAgent(conf.get("postgresql", "uri")), False))
+        pgagents = load_pg_agents(conf, pg_agent_class)
+        pg_options = {"full": not cmd_args["noalldb"],
+                      "intervals": intervals,
+                      "timeouts": load_per_metric(conf, "timeout"),
+                      "metric_timeout": conf.getfloat("postgresql", "metric_timeout", fallback=None),
+                      "telemetry_interval": telemetry_interval,
+                      "instrument_interval": instrument_interval,
+                      "stages": load_stages(conf)}
+        # 多个实例默认并发采集，一个实例变慢不会拖住其它实例
+        if conf.getboolean("postgresql", "parallel", fallback=len(pgagents) > 1):
+            pg_options["workers"] = conf.getint("postgresql", "workers",
+                                                fallback=max(a.pool_size for a in pgagents))
+        component_agent_map.append((PGMonitor, pgagents, pg_options))
 
         workers = []
-        message_queue = multiprocessing.Queue()
+        message_queue = EventQueue(maxsize=conf.getint("queue", "maxsize", fallback=100000),
+                                   policy=conf.get("queue", "policy", fallback="block"),
+                                   block_timeout=conf.getfloat("queue", "block_timeout", fallback=None),
+                                   transport=conf.get("queue", "transport", fallback="pipe"),
+                                   table_size=conf.getint("queue", "table_size_mb", fallback=4) << 20)
 
         for each_component in component_agent_map:
             logger.debug("Spawn worker {}".format(each_component[0]))
-            wrk = multiprocessing.Process(target=each_component[0](message_queue, each_component[1], each_component[2]))
+            target = each_component[0](message_queue, each_component[1], **each_component[2])
+            if cmd_args.get("profile_dir"):
+                target = Profiled(target, cmd_args["profile_dir"], each_component[0].__name__)
+            wrk = multiprocessing.Process(target=target, name=each_component[0].__name__)
             wrk.start()
             workers.append(wrk)
 
@@ -81,6 +280,7 @@ def combind_all_components(cmd_args , conf):
 
         for j in workers:
             j.join()
+        message_queue.close()
     except:
         traceback.print_exc()
         killall(None, None)
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import logging
+
+import numpy
+
+logger = logging.getLogger("pg_metric_collect")
+
+
+class CounterRegistry(object):
+    """保存上一周期的累计计数器及其采样时间，按两次采样的差值计算速率。"""
+    def __init__(self):
+        self.samples = {}
+
+
+    def rates(self, key, ts, values, epoch=None):
+        """values 为同一时刻采到的一组累计计数器。
+
+        首次采样、 epoch 变化（统计被重置或实例重启）或任一计数器回退时只记录本次采样，返回 None 。
+        """
+        values = tuple(float(v) if v is not None else 0.0 for v in values)
+        prev = self.samples.get(key)
+        self.samples[key] = (ts, values, epoch)
+        if prev is None:
+            return None
+
+        prev_ts, prev_values, prev_epoch = prev
+        if epoch != prev_epoch:
+            logger.debug("Counter {!s} was reset, skip this sample.".format(key))
+            return None
+        if ts <= prev_ts or len(values) != len(prev_values):
+            return None
+        for cur, last in zip(values, prev_values):
+            if cur < last:
+                logger.debug("Counter {!s} went backwards, skip this sample.".format(key))
+                return None
+
+        elapsed = float(ts - prev_ts)
+        return tuple((cur - last) / elapsed for cur, last in zip(values, prev_values))
+
+
+    def rate(self, key, ts, value, epoch=None):
+        rs = self.rates(key, ts, (value,), epoch)
+        return rs[0] if rs is not None else None
+
+
+class SlotTable(object):
+    """为每个键在一个 (行数, columns) 的数组中分配一行，保存它上一次的累计值。
+
+    行数从 initial 开始按需加倍，最多 max_entries 行，超过后新键不再跟踪。每次完整的采样前调用
+    next_generation ，采样后 evict 归还本次没有出现的键所占的行。
+    """
+    def __init__(self, columns, max_entries, what="entries", initial=256):
+        self.columns = columns
+        self.max_entries = max_entries
+        self.what = what
+        self.generation = 0
+        self.overflowed = False
+        self._allocate(min(initial, max_entries))
+
+
+    def _allocate(self, rows):
+        self.values = numpy.zeros((rows, self.columns))
+        self.stamps = numpy.zeros(rows, dtype=numpy.int64)
+        # 键 -> 行号
+        self.index = {}
+        self.keys = [None] * rows
+        self.free = list(range(rows - 1, -1, -1))
+
+
+    def clear(self):
+        self._allocate(len(self.keys))
+
+
+    def _grow(self):
+        rows = len(self.keys)
+        new_rows = min(rows * 2, self.max_entries)
+        if new_rows <= rows:
+            return False
+        values = numpy.zeros((new_rows, self.columns))
+        values[:rows] = self.values
+        stamps = numpy.zeros(new_rows, dtype=numpy.int64)
+        stamps[:rows] = self.stamps
+        self.values = values
+        self.stamps = stamps
+        self.keys.extend([None] * (new_rows - rows))
+        self.free.extend(range(new_rows - 1, rows - 1, -1))
+        return True
+
+
+    def next_generation(self):
+        self.generation += 1
+
+
+    def slots(self, keys):
+        """返回各键的行号（不跟踪的为 -1）以及是否为已有的键。"""
+        slots = numpy.empty(len(keys), dtype=numpy.int64)
+        known = numpy.zeros(len(keys), dtype=bool)
+        for i, key in enumerate(keys):
+            slot = self.index.get(key)
+            if slot is not None:
+                known[i] = True
+            elif self.free or self._grow():
+                slot = self.index[key] = self.free.pop()
+                self.keys[slot] = key
+            else:
+                if not self.overflowed:
+                    logger.warn("More than {} {}, ignore the new ones.".format(self.max_entries, self.what))
+                    self.overflowed = True
+                slot = -1
+            slots[i] = slot
+        return slots, known
+
+
+    def store(self, slots, current):
+        """保存本次的累计值，current 与 slots 一一对应。"""
+        tracked = slots >= 0
+        self.values[slots[tracked]] = current[tracked]
+        self.stamps[slots[tracked]] = self.generation
+        return tracked
+
+
+    def evict(self):
+        tracked = numpy.fromiter(self.index.values(), dtype=numpy.int64, count=len(self.index))
+        for slot in tracked[self.stamps[tracked] != self.generation]:
+            del self.index[self.keys[slot]]
+            self.keys[slot] = None
+            self.free.append(int(slot))
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import struct
+import logging
+
+from bernhard import pb
+
+logger = logging.getLogger("pg_metric_collect")
+
+# Event 中 time 、 metric_d 两个字段的 protobuf 编码
+TIME_KEY = b"\x08"
+METRIC_D = struct.Struct("<Bd")
+METRIC_D_KEY = (14 << 3) | 1
+# Event 中 ttl 字段（float）的编码
+TTL = struct.Struct("<Bf")
+TTL_KEY = (8 << 3) | 5
+# Msg 中 events 字段
+MSG_EVENTS_KEY = b"\x32"
+
+TEMPLATE_CACHE_SIZE = 100000
+
+
+def encode_varint(value):
+    if value < 0:
+        # int64 的负数按 10 字节补码编码
+        value += 1 << 64
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+class Event(object):
+    """一个指标样本。 tags 保存为 tuple ，(service, tags, host) 相同的样本共用同一个编码模板。
+
+    enqueued_at 是放入进程间队列的时间，只用于统计排队耗时。 ttl 为 None 时使用 Riemann 的默认值。
+    """
+    __slots__ = ("service", "tags", "time", "metric", "host", "enqueued_at", "ttl")
+
+    def __init__(self, service, time=None, metric=None, tags=(), host=None, enqueued_at=None, ttl=None):
+        self.service = service
+        self.tags = tuple(tags) if tags else ()
+        self.time = time
+        self.metric = metric
+        self.host = host
+        self.enqueued_at = enqueued_at
+        self.ttl = ttl
+
+
+    def __reduce__(self):
+        return (Event, (self.service, self.time, self.metric, self.tags, self.host, self.enqueued_at, self.ttl))
+
+
+    def __repr__(self):
+        return "Event(service={!r}, tags={!r}, time={!r}, metric={!r}, host={!r})".format(
+            self.service, self.tags, self.time, self.metric, self.host)
+
+
+class RawMessage(object):
+    """已经编码好的 Msg ，可直接交给 bernhard.Client.transmit 。"""
+    __slots__ = ("raw",)
+
+    def __init__(self, raw):
+        self.raw = raw
+
+
+class EventEncoder(object):
+    """把 Event 编码为 protobuf 字节串。
+
+    service 、 tags 、 host 的编码按 (service, tags, host) 缓存为模板，每个样本只追加编码 time 、 ttl 和 metric_d 。
+    """
+    def __init__(self, cache_size=TEMPLATE_CACHE_SIZE):
+        self.cache_size = cache_size
+        self.templates = {}
+
+
+    def template(self, service, tags, host):
+        key = (service, tags, host)
+        try:
+            return self.templates[key]
+        except KeyError:
+            pass
+        pb_event = pb.Event()
+        pb_event.service = service
+        if host is not None:
+            pb_event.host = host
+        pb_event.tags.extend(tags)
+        raw = pb_event.SerializeToString()
+        if len(self.templates) >= self.cache_size:
+            # 序列过多时整体清空，避免缓存无限增长
+            self.templates.clear()
+        self.templates[key] = raw
+        return raw
+
+
+    def encode(self, event, default_host=None):
+        """返回 pb.Event 的字节串，事件不合法时抛出 TypeError 或 ValueError 。"""
+        if event.metric is None:
+            raise ValueError("Event {} has no metric.".format(event.service))
+        host = event.host if event.host is not None else default_host
+        raw = self.template(event.service, event.tags, host)
+        if event.time is not None:
+            raw += TIME_KEY + encode_varint(int(event.time))
+        if event.ttl is not None:
+            raw += TTL.pack(TTL_KEY, event.ttl)
+        return raw + METRIC_D.pack(METRIC_D_KEY, float(event.metric))
+
+
+    def message(self, raw_events):
+        """把多个编码好的事件拼成一个 Msg 。"""
+        return RawMessage(b"".join(MSG_EVENTS_KEY + encode_varint(len(raw)) + raw for raw in raw_events))
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import time
+import queue
+import logging
+import threading
+import traceback
+import collections
+import multiprocessing
+
+from pg_metric_collect.event import Event
+
+logger = logging.getLogger("pg_metric_collect")
+
+POLICIES = ("block", "drop_oldest", "drop_newest", "coalesce")
+TRANSPORTS = ("pipe", "shm")
+
+
+class EventQueue(object):
+    """采集进程与 Sender 之间的有界队列，队列满时按 policy 处理新事件：
+
+    block       阻塞等待，超过 block_timeout 秒仍放不进去则丢弃
+    drop_oldest 丢弃队列中最旧的事件
+    drop_newest 丢弃新事件
+    coalesce    暂存在本进程中，同一 (service, tags, host) 只保留最新的值，队列有空位时再放入
+
+    transport 为 shm 时事件经共享内存环形队列传递，不再 pickle 。
+    统计数据属于调用 put_many 的（生产者）进程。
+    """
+    def __init__(self, maxsize=100000, policy="block", block_timeout=None, transport="pipe", table_size=4 << 20):
+        if policy not in POLICIES:
+            raise ValueError("Unknown queue policy {}, should be one of {}.".format(policy, ", ".join(POLICIES)))
+        if transport not in TRANSPORTS:
+            raise ValueError("Unknown queue transport {}, should be one of {}.".format(transport, ", ".join(TRANSPORTS)))
+        if transport == "shm":
+            # multiprocessing.shared_memory 需要 Python 3.8+
+            from pg_metric_collect.shm_ring import ShmRing
+            self.q = ShmRing(maxsize, table_size=table_size)
+        else:
+            self.q = multiprocessing.Queue(maxsize)
+        self.transport = transport
+        self.maxsize = maxsize
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.pending = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self._reset_stats()
+
+
+    def _reset_stats(self):
+        self.enqueued = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.put_seconds = 0.0
+        self.put_seconds_max = 0.0
+
+
+    def get(self, block=True, timeout=None):
+        return self.q.get(block, timeout)
+
+
+    def put_nowait(self, event):
+        self.q.put_nowait(event)
+
+
+    def close(self):
+        if self.transport == "shm":
+            self.q.close()
+
+
+    def qsize(self):
+        try:
+            return self.q.qsize()
+        except NotImplementedError:
+            return -1
+
+
+    def _coalesce_key(self, event):
+        return (event.service, event.tags, event.host)
+
+
+    def _flush_pending(self):
+        while self.pending:
+            key, event = self.pending.popitem(last=False)
+            try:
+                self.q.put_nowait(event)
+            except queue.Full:
+                self.pending[key] = event
+                self.pending.move_to_end(key, last=False)
+                return False
+        return True
+
+
+    def _put(self, event):
+        try:
+            self._put_event(event)
+        except (TypeError, ValueError):
+            # shm 传输无法编码的事件
+            logger.error("Can not enqueue event {}: {}".format(event, traceback.format_exc()))
+            self.dropped += 1
+
+
+    def _put_event(self, event):
+        if self.policy == "block":
+            try:
+                self.q.put(event, timeout=self.block_timeout)
+            except queue.Full:
+                self.dropped += 1
+            return
+
+        if not self.pending or self.policy != "coalesce":
+            try:
+                self.q.put_nowait(event)
+                return
+            except queue.Full:
+                pass
+
+        if self.policy == "drop_newest":
+            self.dropped += 1
+        elif self.policy == "drop_oldest":
+            try:
+                self.q.get_nowait()
+                self.dropped += 1
+            except queue.Empty:
+                pass
+            try:
+                self.q.put_nowait(event)
+            except queue.Full:
+                self.dropped += 1
+        else:
+            key = self._coalesce_key(event)
+            if key in self.pending:
+                self.coalesced += 1
+                del self.pending[key]
+            self.pending[key] = event
+
+
+    def put_many(self, events):
+        with self.lock:
+            started = time.time()
+            if self.pending:
+                self._flush_pending()
+            for event in events:
+                event.enqueued_at = started
+                self._put(event)
+            elapsed = time.time() - started
+            self.enqueued += len(events)
+            self.put_seconds += elapsed
+            self.put_seconds_max = max(self.put_seconds_max, elapsed)
+
+
+    def telemetry(self, source):
+        """返回自上次调用以来的队列统计事件，并清零。"""
+        with self.lock:
+            return self._telemetry(source)
+
+
+    def _telemetry(self, source):
+        the_time = int(time.time())
+        tags = ["pg_metric_collect", source, self.policy]
+        rtn = [Event(service="pg_metric_collect.queue_depth",
+                     tags=tags,
+                     time=the_time,
+                     metric=self.qsize()),
+               Event(service="pg_metric_collect.queue_pending",
+                     tags=tags,
+                     time=the_time,
+                     metric=len(self.pending)),
+               Event(service="pg_metric_collect.enqueue_seconds_max",
+                     tags=tags,
+                     time=the_time,
+                     metric=self.put_seconds_max),
+               Event(service="pg_metric_collect.enqueue_seconds_per_event",
+                     tags=tags,
+                     time=the_time,
+                     metric=self.put_seconds / self.enqueued if self.enqueued else 0.0),
+               Event(service="pg_metric_collect.dropped_events",
+                     tags=tags,
+                     time=the_time,
+                     metric=self.dropped),
+               Event(service="pg_metric_collect.coalesced_events",
+                     tags=tags,
+                     time=the_time,
+                     metric=self.coalesced)]
+        if self.dropped:
+            logger.warn("{} dropped {} event(s) because the queue is full.".format(source, self.dropped))
+        self._reset_stats()
+        return rtn
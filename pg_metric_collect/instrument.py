@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import os
+import sys
+import time
+import pstats
+import signal
+import logging
+import cProfile
+import threading
+
+from pg_metric_collect.event import Event
+
+logger = logging.getLogger("pg_metric_collect")
+
+# 每个 2 的幂区间再等分为 2**SUB_BUCKET_BITS 个桶，相对误差约 3%
+SUB_BUCKET_BITS = 5
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+HALF_BUCKETS = SUB_BUCKETS >> 1
+# 以微秒为单位记录，最大约 2**40 微秒
+MAX_EXPONENT = 40
+
+PERCENTILES = ((50, "p50"), (99, "p99"))
+
+
+class Histogram(object):
+    """HDR 风格的对数-线性直方图，值以微秒为单位记录，内存占用固定。"""
+    __slots__ = ("counts", "count", "max")
+
+    def __init__(self):
+        self.counts = [0] * (SUB_BUCKETS + MAX_EXPONENT * HALF_BUCKETS)
+        self.reset()
+
+
+    def reset(self):
+        for i in range(len(self.counts)):
+            self.counts[i] = 0
+        self.count = 0
+        self.max = 0
+
+
+    def _index(self, value):
+        exponent = max(value.bit_length() - SUB_BUCKET_BITS, 0)
+        if exponent == 0:
+            return value
+        if exponent > MAX_EXPONENT:
+            return len(self.counts) - 1
+        # exponent > 0 时 value >> exponent 落在 [HALF_BUCKETS, SUB_BUCKETS)
+        return SUB_BUCKETS + (exponent - 1) * HALF_BUCKETS + (value >> exponent) - HALF_BUCKETS
+
+
+    def _bucket_value(self, index):
+        """桶的上界（微秒）。"""
+        if index < SUB_BUCKETS:
+            return index
+        exponent, offset = divmod(index - SUB_BUCKETS, HALF_BUCKETS)
+        exponent += 1
+        return ((offset + HALF_BUCKETS + 1) << exponent) - 1
+
+
+    def record(self, seconds):
+        value = int(seconds * 1000000)
+        if value < 0:
+            value = 0
+        self.counts[self._index(value)] += 1
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+
+    def percentile(self, q):
+        """返回第 q 百分位的值（秒）。"""
+        if self.count == 0:
+            return 0.0
+        rank = max(int(self.count * q / 100.0 + 0.5), 1)
+        seen = 0
+        for index, cnt in enumerate(self.counts):
+            seen += cnt
+            if seen >= rank:
+                return min(self._bucket_value(index), self.max) / 1000000.0
+        return self.max / 1000000.0
+
+
+class Instruments(object):
+    """一个进程内的直方图与计数器，按 summary_interval 汇总为 pg_metric_collect.* 事件。
+
+    可以被多个线程同时记录。
+    """
+    def __init__(self, summary_interval=60):
+        self.summary_interval = summary_interval
+        self.summary_due = time.time() + summary_interval if summary_interval else None
+        self.histograms = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+
+    def record(self, name, seconds, tags=(), host=None):
+        key = (name, tuple(tags), host)
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = Histogram()
+            hist.record(seconds)
+
+
+    def incr(self, name, tags=(), host=None, value=1):
+        key = (name, tuple(tags), host)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+
+    def due(self, now=None):
+        return self.summary_due is not None and (now or time.time()) >= self.summary_due
+
+
+    def summary(self):
+        """返回自上次汇总以来的 p50/p99/max/count 与计数器事件，并清零。"""
+        now = time.time()
+        the_time = int(now)
+        if self.summary_interval:
+            while self.summary_due <= now:
+                self.summary_due += self.summary_interval
+        rtn = []
+        with self.lock:
+            for (name, tags, host), hist in self.histograms.items():
+                if hist.count == 0:
+                    continue
+                service = "pg_metric_collect." + name
+                event_tags = ("pg_metric_collect",) + tags
+                for q, suffix in PERCENTILES:
+                    rtn.append(Event(service=service + "." + suffix, tags=event_tags, time=the_time,
+                                     metric=hist.percentile(q), host=host))
+                rtn.append(Event(service=service + ".max", tags=event_tags, time=the_time,
+                                 metric=hist.max / 1000000.0, host=host))
+                rtn.append(Event(service=service + ".count", tags=event_tags, time=the_time,
+                                 metric=hist.count, host=host))
+                hist.reset()
+            for (name, tags, host), value in self.counters.items():
+                rtn.append(Event(service="pg_metric_collect." + name, tags=("pg_metric_collect",) + tags,
+                                 time=the_time, metric=value, host=host))
+                self.counters[(name, tags, host)] = 0
+        return rtn
+
+
+class Profiled(object):
+    """用 cProfile 执行 target ，进程退出时把统计写入 directory 。
+
+    <名称>-<pid>.prof 可以交给 snakeviz 、 flameprof 等工具生成火焰图，同名 .txt 是按累计耗时排序的文本报告。
+    只统计进程主线程。
+    """
+    def __init__(self, target, directory, name):
+        self.target = target
+        self.directory = directory
+        self.name = name
+
+
+    def _exit(self, signum, frame):
+        sys.exit(0)
+
+
+    def __call__(self):
+        # 没有自己处理 SIGTERM 的进程也要正常退出，才能写出统计
+        signal.signal(signal.SIGTERM, self._exit)
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            self.target()
+        finally:
+            profiler.disable()
+            path = os.path.join(self.directory, "{}-{}".format(self.name, os.getpid()))
+            profiler.dump_stats(path + ".prof")
+            with open(path + ".txt", "w") as f:
+                stats = pstats.Stats(profiler, stream=f)
+                stats.sort_stats("cumulative").print_stats(50)
+            logger.info("Profile of {} written to {}.prof".format(self.name, path))
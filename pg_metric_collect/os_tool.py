@@ -4,13 +4,192 @@
 import time
 import logging
 import os
+import re
 
 import psutil
 
+from pg_metric_collect.event import Event
+from pg_metric_collect.counter_tool import CounterRegistry
+
 logger = logging.getLogger("pg_metric_collect")
 
+# /proc/diskstats 中扇区固定为 512 字节
+SECTOR_SIZE = 512
+DEFAULT_EXCLUDE_DEVICES = r"^(loop|ram|zram|sr|fd)\d+$"
+MEMINFO_FIELDS = (b"MemTotal:", b"MemFree:", b"MemAvailable:", b"Buffers:", b"Cached:", b"SReclaimable:")
+
+
+class ProcFile(object):
+    """保持打开的 /proc 文件，每次用 preadv 从头读入同一个预先分配的缓冲区。"""
+    def __init__(self, path, size=4096):
+        self.path = path
+        self.fd = os.open(path, os.O_RDONLY)
+        self.buf = bytearray(size)
+        self.length = 0
+        # 打开时先读一次，没有 os.preadv 或读不了的文件在创建 ProcSampler 时就报错，OSInfo 改用 psutil
+        self.read()
+
+
+    def read(self):
+        while True:
+            self.length = os.preadv(self.fd, [self.buf], 0)
+            if self.length < len(self.buf):
+                return self.buf
+            # 缓冲区可能不够大，加倍后重读
+            self.buf = bytearray(len(self.buf) * 2)
+
+
+    def field(self, name):
+        """返回形如 `name   value` 的行中 value 的整数值。"""
+        start = self.buf.find(name, 0, self.length)
+        if start < 0:
+            return None
+        start += len(name)
+        end = self.buf.find(b"\n", start, self.length)
+        return int(self.buf[start:end].split()[0])
+
+
+class ProcSampler(object):
+    """直接读取 /proc/stat 、 /proc/meminfo 、 /proc/loadavg 、 /proc/diskstats （仅 Linux）。
+
+    每个采集周期开始时调用 begin_cycle ，周期内每个文件最多读取一次；
+    CPU 百分比与磁盘速率由两次采样之差计算，第一次采样时没有值。
+    """
+    def __init__(self, devices=None, exclude_devices=DEFAULT_EXCLUDE_DEVICES):
+        self.stat = ProcFile("/proc/stat", 8192)
+        self.meminfo = ProcFile("/proc/meminfo", 8192)
+        self.loadavg = ProcFile("/proc/loadavg", 256)
+        self.diskstats = ProcFile("/proc/diskstats", 16384)
+        self.devices = re.compile(devices) if devices else None
+        self.exclude_devices = re.compile(exclude_devices) if exclude_devices else None
+        self.counters = CounterRegistry()
+        self.device_names = {}
+        self.fresh = set()
+
+
+    def begin_cycle(self):
+        self.fresh = set()
+
+
+    def _read(self, proc_file):
+        if proc_file.path not in self.fresh:
+            proc_file.read()
+            self.fresh.add(proc_file.path)
+        return proc_file
+
+
+    def _device_name(self, raw_name):
+        """返回需要采集的设备名，被过滤的设备返回 None ，结果按原始名字缓存。"""
+        try:
+            return self.device_names[raw_name]
+        except KeyError:
+            pass
+        name = raw_name.decode()
+        if (self.devices is not None and not self.devices.search(name)) or \
+           (self.exclude_devices is not None and self.exclude_devices.search(name)):
+            name = None
+        self.device_names[raw_name] = name
+        return name
+
+
+    def boot_time(self):
+        return self._read(self.stat).field(b"\nbtime ")
+
+
+    def load_average(self):
+        proc_file = self._read(self.loadavg)
+        return [float(v) for v in proc_file.buf[:proc_file.length].split(None, 3)[:3]]
+
+
+    def cpu_percent(self):
+        """返回 (user, system, idle, iowait) 百分比，第一次调用返回 None 。"""
+        proc_file = self._read(self.stat)
+        end = proc_file.buf.find(b"\n", 0, proc_file.length)
+        # cpu  user nice system idle iowait irq softirq steal guest guest_nice
+        ticks = [int(v) for v in proc_file.buf[:end].split()[1:9]]
+        rates = self.counters.rates("cpu", time.time(), ticks)
+        if rates is None:
+            return None
+        total = sum(rates)
+        if total <= 0:
+            return None
+        return tuple(rates[i] * 100.0 / total for i in (0, 2, 3, 4))
+
+
+    def memory(self):
+        """返回 (total, available, used, free, percent) ，单位字节。"""
+        proc_file = self._read(self.meminfo)
+        total, free, available, buffers, cached, reclaimable = [(proc_file.field(name) or 0) * 1024
+                                                                for name in MEMINFO_FIELDS]
+        cached += reclaimable
+        used = total - free - buffers - cached
+        if used < 0:
+            used = total - free
+        percent = (total - available) * 100.0 / total if total else 0.0
+        return total, available, used, free, percent
+
+
+    def disk_io(self):
+        """返回 [(设备, 累计值, 速率)] 。
+
+        累计值为 (read_bytes, write_bytes, read_time, write_time) ，时间单位毫秒；
+        速率为 (read_bytes/s, write_bytes/s, read_iops, write_iops, await_ms, util_percent) ，第一次采样时为 None 。
+        """
+        proc_file = self._read(self.diskstats)
+        now = time.time()
+        rtn = []
+        buf = proc_file.buf
+        start = 0
+        while start < proc_file.length:
+            end = buf.find(b"\n", start, proc_file.length)
+            if end < 0:
+                end = proc_file.length
+            fields = buf[start:end].split()
+            start = end + 1
+            if len(fields) < 14:
+                continue
+            device = self._device_name(bytes(fields[2]))
+            if device is None:
+                continue
+            reads, sectors_read, read_ms = int(fields[3]), int(fields[5]), int(fields[6])
+            writes, sectors_written, write_ms = int(fields[7]), int(fields[9]), int(fields[10])
+            io_ms = int(fields[12])
+            totals = (sectors_read * SECTOR_SIZE, sectors_written * SECTOR_SIZE, read_ms, write_ms)
+            rates = self.counters.rates(("disk", device), now,
+                                        [totals[0], totals[1], reads, writes, read_ms + write_ms, io_ms])
+            if rates is not None:
+                ios = rates[2] + rates[3]
+                rates = (rates[0], rates[1], rates[2], rates[3],
+                         rates[4] / ios if ios > 0 else 0.0,
+                         min(rates[5] / 10.0, 100.0))
+            rtn.append(("/dev/{}".format(device), totals, rates))
+        return rtn
+
 
 class OSInfo(object):
+    """sampler 为 proc 且系统有 /proc 时直接读取 /proc ，否则使用 psutil 。"""
+    def __init__(self, sampler="proc", devices=None, exclude_devices=DEFAULT_EXCLUDE_DEVICES):
+        self.sampler = None
+        if sampler == "proc":
+            try:
+                self.sampler = ProcSampler(devices, exclude_devices)
+            except (OSError, AttributeError):
+                # 不是 Linux ，或者 Python 没有 os.preadv
+                logger.info("/proc is not available, sample OS metrics with psutil.")
+        self.devices = re.compile(devices) if devices else None
+        self.exclude_devices = re.compile(exclude_devices) if exclude_devices else None
+
+
+    def begin_cycle(self):
+        if self.sampler is not None:
+            self.sampler.begin_cycle()
+
+
+    def _device_wanted(self, device):
+        return not ((self.devices is not None and not self.devices.search(device)) or
+                    (self.exclude_devices is not None and self.exclude_devices.search(device)))
+
+
     def bytes2human(self, n):
         symbols = ("KB", "MB", "GB", "TB", "PB", "EB", "ZB", "YB")
         prefix = {}
@@ -24,80 +203,91 @@ class OSInfo(object):
 
 
     def metric_boot_time(self):
-        return [{"service": "boot_time",
-                 "time": int(time.mktime(time.localtime())),
-                 "metric": time.mktime(time.localtime(psutil.boot_time()))}]
+        return [Event(service="boot_time",
+                      time=int(time.mktime(time.localtime())),
+                      metric=self.sampler.boot_time() if self.sampler is not None else psutil.boot_time())]
     
 
     def metric_average_load(self):
-        avg_load = os.getloadavg()
+        avg_load = self.sampler.load_average() if self.sampler is not None else os.getloadavg()
         the_time = int(time.mktime(time.localtime()))
-        return [{"service": "1min",
-                 "time": the_time,
-                 "tags": ["avg_load"],
-                 "metric": avg_load[0]},
-                {"service": "5min",
-                 "time": the_time,
-                 "tags": ["avg_load"],
-                 "metric": avg_load[1]},
-                {"service": "15min",
-                 "time": the_time,
-                 "tags": ["avg_load"],
-                 "metric": avg_load[2]}]
+        return [Event(service="1min",
+                      time=the_time,
+                      tags=["avg_load"],
+                      metric=avg_load[0]),
+                Event(service="5min",
+                      time=the_time,
+                      tags=["avg_load"],
+                      metric=avg_load[1]),
+                Event(service="15min",
+                      time=the_time,
+                      tags=["avg_load"],
+                      metric=avg_load[2])]
 
 
     def metric_cpu_cores(self):
         the_time = int(time.mktime(time.localtime()))
         cpu_cores = psutil.cpu_count()
-        return [{"service": "cpu_cores",
-                 "time": the_time,
-                 "metric": cpu_cores}]
+        return [Event(service="cpu_cores",
+                      time=the_time,
+                      metric=cpu_cores)]
 
 
     def metric_cpu_percent(self):
-        cp = psutil.cpu_times_percent()
+        if self.sampler is not None:
+            cp = self.sampler.cpu_percent()
+            if cp is None:
+                return []
+            user, system, idle, iowait = cp
+        else:
+            cp = psutil.cpu_times_percent()
+            user, system, idle, iowait = cp.user, cp.system, cp.idle, cp.iowait
         the_time = int(time.mktime(time.localtime()))
-        return [{"service": "user",
-                 "tags": ["cpu_percent"],
-                 "time": the_time,
-                 "metric": cp.user},
-                {"service": "system",
-                 "tags": ["cpu_percent"],
-                 "time": the_time,
-                 "metric": cp.system},
-                {"service": "idle",
-                 "tags": ["cpu_percent"],
-                 "time": the_time,
-                 "metric": cp.idle},
-                {"service": "iowait",
-                 "tags": ["cpu_percent"],
-                 "time": the_time,
-                 "metric": cp.iowait}]
+        return [Event(service="user",
+                      tags=["cpu_percent"],
+                      time=the_time,
+                      metric=user),
+                Event(service="system",
+                      tags=["cpu_percent"],
+                      time=the_time,
+                      metric=system),
+                Event(service="idle",
+                      tags=["cpu_percent"],
+                      time=the_time,
+                      metric=idle),
+                Event(service="iowait",
+                      tags=["cpu_percent"],
+                      time=the_time,
+                      metric=iowait)]
 
 
     def metric_memory(self):
-        vm = psutil.virtual_memory()
+        if self.sampler is not None:
+            total, available, used, free, percent = self.sampler.memory()
+        else:
+            vm = psutil.virtual_memory()
+            total, available, used, free, percent = vm.total, vm.available, vm.used, vm.free, vm.percent
         the_time = int(time.mktime(time.localtime()))
-        return [{"service": "memory_total",
-                 "tags": ["memory_info"],
-                 "time": the_time,
-                 "metric": vm.total},
-                {"service": "memory_available",
-                 "tags": ["memory_info"],
-                 "time": the_time,
-                 "metric": vm.available},
-                {"service": "memory_used",
-                 "tags": ["memory_info"],
-                 "time": the_time,
-                 "metric": vm.used},
-                {"service": "memory_free",
-                 "tags": ["memory_info"],
-                 "time": the_time,
-                 "metric": vm.free},
-                {"service": "memory_percent",
-                 "tags": ["memory_info"],
-                 "time": the_time,
-                 "metric": vm.percent}]
+        return [Event(service="memory_total",
+                      tags=["memory_info"],
+                      time=the_time,
+                      metric=total),
+                Event(service="memory_available",
+                      tags=["memory_info"],
+                      time=the_time,
+                      metric=available),
+                Event(service="memory_used",
+                      tags=["memory_info"],
+                      time=the_time,
+                      metric=used),
+                Event(service="memory_free",
+                      tags=["memory_info"],
+                      time=the_time,
+                      metric=free),
+                Event(service="memory_percent",
+                      tags=["memory_info"],
+                      time=the_time,
+                      metric=percent)]
 
 
     def metric_disk_usage(self, mount_points=None):
@@ -112,45 +302,41 @@ class OSInfo(object):
         for each_mount_point in mount_points:
             du = psutil.disk_usage(each_mount_point)
             the_time = int(time.mktime(time.localtime()))
-            rtn.append({"service": "disk_total",
-                        "tags": ["disk_info", each_mount_point],
-                        "time": the_time,
-                        "metric": du.total})
-            rtn.append({"service": "disk_used",
-                        "tags": ["disk_info", each_mount_point],
-                        "time": the_time,
-                        "metric": du.used})
-            rtn.append({"service": "disk_free",
-                        "tags": ["disk_info", each_mount_point],
-                        "time": the_time,
-                        "metric": du.free})
-            rtn.append({"service": "disk_percent",
-                        "tags": ["disk_info", each_mount_point],
-                        "time": the_time,
-                        "metric": du.percent})
+            rtn.append(Event(service="disk_total",
+                             tags=["disk_info", each_mount_point],
+                             time=the_time,
+                             metric=du.total))
+            rtn.append(Event(service="disk_used",
+                             tags=["disk_info", each_mount_point],
+                             time=the_time,
+                             metric=du.used))
+            rtn.append(Event(service="disk_free",
+                             tags=["disk_info", each_mount_point],
+                             time=the_time,
+                             metric=du.free))
+            rtn.append(Event(service="disk_percent",
+                             tags=["disk_info", each_mount_point],
+                             time=the_time,
+                             metric=du.percent))
         return rtn
 
 
     def metric_disk_io(self):
-        dio = psutil.disk_io_counters(perdisk=True)
+        if self.sampler is not None:
+            samples = self.sampler.disk_io()
+        else:
+            samples = [("/dev/{}".format(device), (per_io.read_bytes, per_io.write_bytes,
+                                                   per_io.read_time, per_io.write_time), None)
+                       for device, per_io in psutil.disk_io_counters(perdisk=True).items()
+                       if self._device_wanted(device)]
         rtn = []
-        for device, per_io in dio.items():
-            dev_path = "/dev/{}".format(device)
-            the_time = int(time.mktime(time.localtime()))
-            rtn.append({"service": "read_bytes",
-                        "tags": ["disk_io", dev_path],
-                        "time": the_time,
-                        "metric": per_io.read_bytes})
-            rtn.append({"service": "write_bytes",
-                        "tags": ["disk_io", dev_path],
-                        "time": the_time,
-                        "metric": per_io.write_bytes})
-            rtn.append({"service": "read_time",
-                        "tags": ["disk_io", dev_path],
-                        "time": the_time,
-                        "metric": per_io.read_time})
-            rtn.append({"service": "write_time",
-                        "tags": ["disk_io", dev_path],
-                        "time": the_time,
-                        "metric": per_io.write_time})
+        the_time = int(time.mktime(time.localtime()))
+        for dev_path, totals, rates in samples:
+            tags = ["disk_io", dev_path]
+            for service, value in zip(("read_bytes", "write_bytes", "read_time", "write_time"), totals):
+                rtn.append(Event(service=service, tags=tags, time=the_time, metric=value))
+            if rates is not None:
+                for service, value in zip(("read_bytes_per_second", "write_bytes_per_second",
+                                           "read_iops", "write_iops", "await_ms", "util_percent"), rates):
+                    rtn.append(Event(service=service, tags=tags, time=the_time, metric=value))
         return rtn
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import re
+import time
+import logging
+import threading
+
+import numpy
+
+from pg_metric_collect.event import Event
+
+logger = logging.getLogger("pg_metric_collect")
+
+
+WINDOW_STATS = ("min", "max", "mean", "p95")
+
+
+class ServiceMatcher(object):
+    """按正则匹配 service ，每个 service 只匹配一次。"""
+    def __init__(self, pattern):
+        self.pattern = re.compile(pattern)
+        self.matched = {}
+
+
+    def __call__(self, service):
+        try:
+            return self.matched[service]
+        except KeyError:
+            rtn = self.matched[service] = self.pattern.search(service) is not None
+            return rtn
+
+
+class DedupStage(object):
+    """只在取值变化时发送匹配 services 的序列，不变的样本每隔 heartbeat 秒仍发送一次。
+
+    以 (host, service, tags) 区分序列，与上一次发送的值比较，相对变化不超过 epsilon 视为不变。
+    这些序列的事件带上 ttl （默认 heartbeat 的两倍），采集停止后仍能在 Riemann 中按过期告警。
+    """
+    next_flush = None
+
+    def __init__(self, services, heartbeat=300, epsilon=0.0, ttl=None):
+        self.services = ServiceMatcher(services)
+        self.heartbeat = heartbeat
+        self.epsilon = epsilon
+        self.ttl = ttl if ttl is not None else heartbeat * 2
+        self.lock = threading.Lock()
+        # (host, service, tags) -> (发送时间, 发送的值)
+        self.last = {}
+        self.sweep_due = time.time() + heartbeat
+
+
+    def _changed(self, old, new):
+        if old is None or new is None:
+            return old is not new
+        # SUM() 等返回的是 Decimal
+        return abs(float(new) - float(old)) > self.epsilon * abs(float(old))
+
+
+    def _sweep(self, now):
+        """丢弃超过两个 heartbeat 没有新样本的序列，例如已经删除的数据库。"""
+        expired = [key for key, (sent, _) in self.last.items() if now - sent > self.heartbeat * 2]
+        for key in expired:
+            del self.last[key]
+        self.sweep_due = now + self.heartbeat
+
+
+    def process(self, events):
+        now = time.time()
+        rtn = []
+        with self.lock:
+            for event in events:
+                if not self.services(event.service):
+                    rtn.append(event)
+                    continue
+                key = (event.host, event.service, event.tags)
+                last = self.last.get(key)
+                if last is not None and now - last[0] < self.heartbeat and not self._changed(last[1], event.metric):
+                    continue
+                self.last[key] = (now, event.metric)
+                event.ttl = self.ttl
+                rtn.append(event)
+            if now >= self.sweep_due:
+                self._sweep(now)
+        return rtn
+
+
+class WindowStage(object):
+    """把匹配 services 的序列在本地按 window 秒聚合，每个窗口结束时发送一次统计值。
+
+    每个序列在一个二维数组中占一行，最多保存最近 samples 个样本，窗口结束时对所有序列一起计算；
+    行数从 initial 开始按需加倍，最多 max_series 行。
+    最后一个样本沿用原来的 service ，最小、最大、平均值和 p95 发送为 <service>.min 等，
+    都带上 window_<window>s 标签。序列数超过 max_series 时，新序列的样本不聚合，照原样发送。
+    """
+    def __init__(self, services, window=10, samples=64, max_series=10000, initial=256):
+        self.services = ServiceMatcher(services)
+        self.window = window
+        self.samples = samples
+        self.max_series = max_series
+        self.window_tag = "window_{:g}s".format(window)
+        self.lock = threading.Lock()
+        rows = min(initial, max_series)
+        self.values = numpy.full((rows, samples), numpy.nan)
+        self.counts = numpy.zeros(rows, dtype=numpy.int64)
+        # (host, service, tags) -> 行号
+        self.index = {}
+        self.keys = [None] * rows
+        self.free = list(range(rows - 1, -1, -1))
+        self.overflowed = False
+        self.next_flush = (int(time.time() / window) + 1) * window
+
+
+    def _grow(self):
+        rows = len(self.keys)
+        new_rows = min(rows * 2, self.max_series)
+        if new_rows <= rows:
+            return False
+        values = numpy.full((new_rows, self.samples), numpy.nan)
+        values[:rows] = self.values
+        counts = numpy.zeros(new_rows, dtype=numpy.int64)
+        counts[:rows] = self.counts
+        self.values = values
+        self.counts = counts
+        self.keys.extend([None] * (new_rows - rows))
+        self.free.extend(range(new_rows - 1, rows - 1, -1))
+        return True
+
+
+    def process(self, events):
+        rtn = []
+        with self.lock:
+            for event in events:
+                if event.metric is None or not self.services(event.service):
+                    rtn.append(event)
+                    continue
+                key = (event.host, event.service, event.tags)
+                row = self.index.get(key)
+                if row is None:
+                    if not self.free and not self._grow():
+                        if not self.overflowed:
+                            logger.warn("More than {} series to aggregate, send the rest unaggregated.".format(
+                                self.max_series))
+                            self.overflowed = True
+                        rtn.append(event)
+                        continue
+                    row = self.index[key] = self.free.pop()
+                    self.keys[row] = key
+                # 超过 samples 个样本时循环覆盖最早的
+                self.values[row, self.counts[row] % self.samples] = event.metric
+                self.counts[row] += 1
+        return rtn
+
+
+    def flush(self, now=None):
+        now = now or time.time()
+        with self.lock:
+            self.next_flush = (int(now / self.window) + 1) * self.window
+            # 本窗口没有样本的序列不再保留
+            known = numpy.fromiter(self.index.values(), dtype=numpy.int64, count=len(self.index))
+            for row in known[self.counts[known] == 0]:
+                del self.index[self.keys[row]]
+                self.keys[row] = None
+                self.free.append(int(row))
+            rows = numpy.flatnonzero(self.counts)
+            if len(rows) == 0:
+                return []
+            values = self.values[rows]
+            lasts = values[numpy.arange(len(rows)), (self.counts[rows] - 1) % self.samples]
+            stats = (numpy.nanmin(values, axis=1),
+                     numpy.nanmax(values, axis=1),
+                     numpy.nanmean(values, axis=1),
+                     numpy.nanpercentile(values, 95, axis=1))
+            keys = [self.keys[row] for row in rows]
+            self.values[rows] = numpy.nan
+            self.counts[rows] = 0
+
+        the_time = int(now)
+        rtn = []
+        for i, (host, service, tags) in enumerate(keys):
+            tags = tags + (self.window_tag,)
+            rtn.append(Event(service=service, tags=tags, host=host, time=the_time, metric=float(lasts[i])))
+            for name, values in zip(WINDOW_STATS, stats):
+                rtn.append(Event(service="{}.{}".format(service, name), tags=tags, host=host,
+                                 time=the_time, metric=float(values[i])))
+        return rtn
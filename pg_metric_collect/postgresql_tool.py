@@ -3,25 +3,195 @@
 
 import traceback
 import logging
+import threading
 import time
+import copy
+import math
+import collections
 
 from sqlalchemy import create_engine
 from sqlalchemy import text
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import DBAPIError
+
+from pg_metric_collect.counter_tool import CounterRegistry
+from pg_metric_collect.statements_tool import StatementsTracker
+from pg_metric_collect.statements_tool import QueryClassifier
+from pg_metric_collect.relation_tool import RelationTracker
+from pg_metric_collect.relation_tool import COLUMNS as RELATION_COLUMNS
+from pg_metric_collect.event import Event
 
 logger = logging.getLogger("pg_metric_collect")
 
+# 由 pg_stat_statements 各条目求和的累计值
+STATEMENTS_TOTALS = ("calls", "rows", "shared_dirtied", "local_dirtied", "shared_written", "local_written")
+
+
+class CycleCache(object):
+    """单个采集周期内的查询结果缓存，多个线程同时请求同一项时只查询一次。"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.key_locks = {}
+        self.values = {}
+
+
+    def get(self, key, loader):
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            if key not in self.values:
+                self.values[key] = loader()
+            return self.values[key]
+
+
+class QueryResult(object):
+    """已经取回全部行的查询结果，不再占用数据库连接。"""
+    def __init__(self, rows, columns=None):
+        self.rows = rows
+        self.columns = columns
+
+
+    def fetchall(self):
+        return self.rows
+
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+
+class DatabaseAgents(object):
+    """同一实例上各个数据库的 PGAgent ，数量有上限，按最近最少使用以及空闲时间淘汰。
+
+    factory(url) 创建连接到 url 的 PGAgent 。
+    """
+    def __init__(self, url, capacity, idle_timeout, factory):
+        self.url = url
+        self.factory = factory
+        self.capacity = max(capacity, 1)
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.agents = collections.OrderedDict()
+
+
+    def get(self, dbname):
+        with self.lock:
+            entry = self.agents.pop(dbname, None)
+            if entry is None:
+                url = copy.copy(self.url)
+                url.database = dbname
+                entry = [self.factory(url), 0]
+            entry[1] = time.time()
+            self.agents[dbname] = entry
+
+            while len(self.agents) > self.capacity:
+                old_dbname, old_entry = self.agents.popitem(last=False)
+                logger.debug("Close connection of database {}.".format(old_dbname))
+                old_entry[0].eng.dispose()
+            return entry[0]
+
+
+    def evict_idle(self):
+        now = time.time()
+        with self.lock:
+            for dbname, entry in list(self.agents.items()):
+                if now - entry[1] > self.idle_timeout:
+                    logger.debug("Close idle connection of database {}.".format(dbname))
+                    del self.agents[dbname]
+                    entry[0].eng.dispose()
+
 
 class PGAgent(object):
-    def __init__(self, uri):
-        logger.debug("Use database uri: {}".format(uri))
-        self.eng = create_engine(uri, pool_size=10, pool_recycle=300)
-        self.cur_dbname = uri.split('/')[-1]
+    def __init__(self, uri, pool_size=10, session=False, statement_timeout=None,
+                 application_name="pg_metric_collect", host_tag=None, retry_interval=30,
+                 all_databases=False, max_db_connections=10, db_idle_timeout=300, dbs_per_cycle=None,
+                 recorder=None, backend=None, statements_top_n=10, statements_max_entries=20000,
+                 size_mode="walk", size_refresh_interval=300, size_dbs_per_cycle=None,
+                 relation_stats_batch=1000, relation_stats_top_n=50, relation_stats_max_entries=200000,
+                 relation_trackers=None, connect_timeout=10):
+        logger.debug("Use database uri: {!r}".format(make_url(uri)))
+        self.pool_size = pool_size
+        # host_tag 为 None 时事件使用 [riemann] host_tag
+        self.host_tag = host_tag
+        self.retry_interval = retry_interval
+        self.down_until = 0
+        # 连接超时由 libpq 控制，一个连不上的实例不应长时间占用采集线程
+        self.connect_timeout = connect_timeout
+        connect_args = {"connect_timeout": connect_timeout} if connect_timeout else {}
+        self.eng = create_engine(uri, pool_size=pool_size, pool_recycle=300, connect_args=connect_args)
+        self.cur_dbname = self.eng.url.database
 
         self.first_run = True
+        self.cycle_cache = CycleCache()
+        self.counters = CounterRegistry()
+
+        # session 模式：一个长连接，固定的指标 SQL 使用服务端预备语句，每个周期一个只读事务
+        self.session = session
+        self.statement_timeout = statement_timeout
+        self.application_name = application_name
+        self.session_lock = threading.RLock()
+        self.session_conn = None
+        self.session_trans = None
+        self.prepared = {}
+
+        # 对实例上的每个数据库分别采集数据库级别的指标，每个周期轮流处理其中 dbs_per_cycle 个
+        self.all_databases = all_databases
+        self.dbs_per_cycle = dbs_per_cycle or max_db_connections
+        self.fanout_cursor = 0
+        self.database_agents = DatabaseAgents(self.eng.url, max_db_connections, db_idle_timeout,
+                                              self._database_agent)
+
+        # recorder 记录每次查询的结果；设置了 backend （例如 ReplayBackend）时查询由它返回，不连接数据库
+        self.recorder = recorder
+        self.backend = backend
+
+        self.server_version = None
+        self.cur_dboid = None
+        self.oid_names = {}
+        self.classifier = QueryClassifier()
+        # 跟踪的数组在第一次采集 top_statements 时才分配，各数据库的 PGAgent 不会用到
+        self.statements = None
+        self.statements_top_n = statements_top_n
+        self.statements_max_entries = statements_max_entries
+
+        # 数据库大小的缓存： datname -> (大小, 测量时间)
+        self.size_mode = size_mode
+        self.size_refresh_interval = size_refresh_interval
+        self.size_dbs_per_cycle = size_dbs_per_cycle
+        self.size_last_run = None
+        self.db_sizes = {}
+
+        # 每个表的统计： datname -> RelationTracker ，在第一次采集该数据库时才创建。
+        # 各数据库的 PGAgent 可能被 DatabaseAgents 淘汰，它们共用这里的 relation_trackers
+        self.relation_stats_batch = relation_stats_batch
+        self.relation_stats_top_n = relation_stats_top_n
+        self.relation_stats_max_entries = relation_stats_max_entries
+        self.relation_trackers = relation_trackers if relation_trackers is not None else {}
+        self.relation_names = {}
+
+
+    def _database_agent(self, url):
+        return PGAgent(url, pool_size=1, recorder=self.recorder, backend=self.backend,
+                       connect_timeout=self.connect_timeout,
+                       relation_stats_batch=self.relation_stats_batch,
+                       relation_stats_top_n=self.relation_stats_top_n,
+                       relation_stats_max_entries=self.relation_stats_max_entries,
+                       relation_trackers=self.relation_trackers)
 
 
     def execute_sql(self, sql_str, params=None):
-        with self.eng.connect() as conn:
+        if self.backend is not None:
+            result = self.backend.execute(sql_str, params, database=self.eng.url.database)
+        elif self.session:
+            result = self._execute_in_session(sql_str, params)
+        else:
+            result = self._execute_pooled(sql_str, params)
+        if self.recorder is not None and result is not None:
+            self.recorder.record(self.eng.url.database, sql_str, result)
+        return result
+
+
+    def _execute_pooled(self, sql_str, params):
+        with self._connect() as conn:
             sql_text = text(sql_str).execution_options(autocommit=False)
             trans = conn.begin()
             try:
@@ -30,14 +200,319 @@ class PGAgent(object):
                 else:
                     qrs = conn.execute(sql_text)
 
+                rows = qrs.fetchall() if qrs.returns_rows else []
                 trans.commit()
-                return qrs
+                return QueryResult(rows, qrs.keys() if qrs.returns_rows else [])
             except:
                 trans.rollback()
                 logger.error("ERR SQL: {}".format(sql_str))
                 logger.error(traceback.format_exc())
 
 
+    def stream_sql(self, sql_str, batch_size=1000, params=None):
+        """通过服务端游标逐批返回结果行，不一次取回全部结果。
+
+        设置了 backend 或 recorder 时按 execute_sql 一次取回，再分批返回（录制的是完整结果）。
+        """
+        if self.backend is not None or self.recorder is not None:
+            result = self.execute_sql(sql_str, params)
+            rows = result.fetchall() if result is not None else []
+            for i in range(0, len(rows), batch_size):
+                yield rows[i:i + batch_size]
+            return
+
+        if self.session:
+            with self.session_lock:
+                try:
+                    if self.session_conn is None:
+                        self._open_session()
+                    if self.session_trans is None:
+                        self.session_trans = self.session_conn.begin()
+                        self.session_conn.execute(text("SET TRANSACTION READ ONLY"))
+                    qrs = self.session_conn.execution_options(stream_results=True).execute(text(sql_str),
+                                                                                            params or {})
+                    while True:
+                        rows = qrs.fetchmany(batch_size)
+                        if not rows:
+                            break
+                        yield rows
+                except Exception:
+                    logger.error("ERR SQL: {}".format(sql_str))
+                    logger.error(traceback.format_exc())
+                    self._abort_session_transaction()
+            return
+
+        with self._connect() as conn:
+            trans = conn.begin()
+            try:
+                qrs = conn.execution_options(stream_results=True).execute(text(sql_str), params or {})
+                while True:
+                    rows = qrs.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    yield rows
+                qrs.close()
+                trans.commit()
+            except Exception:
+                # 不捕获 GeneratorExit ，调用方提前结束时只是关闭游标
+                trans.rollback()
+                logger.error("ERR SQL: {}".format(sql_str))
+                logger.error(traceback.format_exc())
+
+
+    def available(self):
+        """连接失败后的 retry_interval 秒内不再尝试该实例。"""
+        return time.time() >= self.down_until
+
+
+    def _connect(self):
+        try:
+            return self.eng.connect()
+        except DBAPIError:
+            if not self.available():
+                raise
+            self.down_until = time.time() + self.retry_interval
+            logger.error("Could not connect to {}, retry in {} seconds.".format(repr(self.eng.url), self.retry_interval))
+            raise
+
+
+    def _open_session(self):
+        conn = self._connect()
+        with conn.begin():
+            conn.execute(text("SELECT set_config('application_name', :app, false)"),
+                         {"app": self.application_name})
+            if self.statement_timeout is not None:
+                conn.execute(text("SELECT set_config('statement_timeout', :timeout, false)"),
+                             {"timeout": str(self.statement_timeout)})
+        self.session_conn = conn
+        self.prepared = {}
+        logger.debug("Opened collection session as {}.".format(self.application_name))
+
+
+    def _close_session(self):
+        if self.session_conn is not None:
+            try:
+                self.session_conn.close()
+            except:
+                logger.debug(traceback.format_exc())
+        self.session_conn = None
+        self.session_trans = None
+        self.prepared = {}
+
+
+    def _prepare(self, sql_str):
+        name = self.prepared.get(sql_str)
+        if name is None:
+            name = "pgmc_{}".format(len(self.prepared) + 1)
+            self.session_conn.execute(text("PREPARE {} AS {}".format(name, sql_str)))
+            self.prepared[sql_str] = name
+        return name
+
+
+    def _execute_in_session(self, sql_str, params):
+        with self.session_lock:
+            for attempt in range(2):
+                try:
+                    if self.session_conn is None:
+                        self._open_session()
+                    if self.session_trans is None:
+                        self.session_trans = self.session_conn.begin()
+                        self.session_conn.execute(text("SET TRANSACTION READ ONLY"))
+
+                    if params is not None and isinstance(params, dict):
+                        qrs = self.session_conn.execute(text(sql_str), params)
+                    else:
+                        qrs = self.session_conn.execute(text("EXECUTE {}".format(self._prepare(sql_str))))
+                    if not qrs.returns_rows:
+                        return QueryResult([], [])
+                    return QueryResult(qrs.fetchall(), qrs.keys())
+                except DBAPIError as e:
+                    if e.connection_invalidated and attempt == 0:
+                        logger.warn("Collection session lost, reconnect.")
+                        self._close_session()
+                        continue
+                    logger.error("ERR SQL: {}".format(sql_str))
+                    logger.error(traceback.format_exc())
+                    self._abort_session_transaction()
+                    return None
+                except:
+                    logger.error("ERR SQL: {}".format(sql_str))
+                    logger.error(traceback.format_exc())
+                    self._abort_session_transaction()
+                    return None
+
+
+    def _abort_session_transaction(self):
+        self._end_session_transaction(commit=False)
+        if self.session_conn is None:
+            return
+        # 回滚后预备语句是否还在无法确定，全部释放后按需重新 PREPARE
+        try:
+            with self.session_conn.begin():
+                self.session_conn.execute(text("DEALLOCATE ALL"))
+            self.prepared = {}
+        except:
+            logger.debug(traceback.format_exc())
+            self._close_session()
+
+
+    def _end_session_transaction(self, commit=True):
+        if self.session_trans is None:
+            return
+        trans = self.session_trans
+        self.session_trans = None
+        try:
+            if commit:
+                trans.commit()
+            else:
+                trans.rollback()
+        except:
+            logger.warn("Could not end collection transaction, drop the session.")
+            logger.debug(traceback.format_exc())
+            self._close_session()
+
+
+    def begin_cycle(self):
+        """每个采集周期开始时调用，丢弃上一周期缓存的快照。"""
+        self.cycle_cache = CycleCache()
+        if self.all_databases:
+            self.database_agents.evict_idle()
+
+
+    def end_cycle(self):
+        """每个采集周期结束时调用，结束 session 模式下本周期的只读事务。"""
+        if self.session:
+            with self.session_lock:
+                self._end_session_transaction()
+
+
+    def _cycle_cached(self, key, loader):
+        return self.cycle_cache.get(key, loader)
+
+
+    def _load_session_snapshot(self):
+        rspxy = self.execute_sql("""SELECT extract(epoch from now())::int                   AS ts
+                                         , current_setting('max_connections')::float        AS max_conns
+                                         , datname
+                                         , usename
+                                         , pid
+                                         , state
+                                         , wait_event IS NOT NULL                            AS waiting
+                                         , query NOT LIKE 'autovacuum:%'                     AS user_query
+                                         , extract(epoch from now()-backend_start)           AS backend_age
+                                         , extract(epoch from now()-xact_start)              AS xact_age
+                                         , extract(epoch from now()-query_start)             AS query_age
+                                         , extract(epoch from now()-state_change)            AS state_age
+                                      FROM pg_stat_activity """)
+        rs = rspxy.fetchall()
+        if not rs:
+            return int(time.mktime(time.localtime())), None, []
+        return rs[0].ts, rs[0].max_conns, rs
+
+
+    def _session_snapshot(self):
+        """一个周期内只扫描一次 pg_stat_activity ，所有会话类指标都由该快照计算。"""
+        return self._cycle_cached("sessions", self._load_session_snapshot)
+
+
+    def _count_sessions_by_db(self, predicate):
+        counts = {}
+        for s in self._session_snapshot()[2]:
+            counts[s.datname] = counts.get(s.datname, 0) + (1 if predicate(s) else 0)
+        return counts
+
+
+    def _load_statements_snapshot(self):
+        """不读取语句文本，新出现的 queryid 再按需读取文本并分类。"""
+        version = self._server_version()
+        total_time = "total_exec_time" if version is not None and version >= 130000 else "total_time"
+        rspxy = self.execute_sql("""SELECT dbid
+                                         , userid
+                                         , queryid
+                                         , calls
+                                         , {}                                                          AS total_time
+                                         , rows
+                                         , shared_blks_read + local_blks_read + temp_blks_read          AS blks_read
+                                         , shared_blks_written + local_blks_written + temp_blks_written AS blks_written
+                                         , shared_blks_dirtied                                         AS shared_dirtied
+                                         , local_blks_dirtied                                          AS local_dirtied
+                                         , shared_blks_written                                         AS shared_written
+                                         , local_blks_written                                          AS local_written
+                                      FROM pg_stat_statements(showtext := false) """.format(total_time))
+        the_time = time.time()
+        rs = rspxy.fetchall()
+        queryids = [r[2] for r in rs]
+        missing = self.classifier.missing(queryids)
+        if missing:
+            rspxy = self.execute_sql("""SELECT queryid
+                                             , left(query, 64)
+                                          FROM pg_stat_statements(showtext := true)
+                                         WHERE queryid = ANY(:queryids) """, {"queryids": missing})
+            if rspxy is not None:
+                self.classifier.learn(rspxy.fetchall())
+        self.classifier.retain(queryids)
+        return the_time, rs
+
+
+    def _statements_snapshot(self):
+        """一个周期内只读取一次 pg_stat_statements ，返回 (时间, 各条目) 。"""
+        return self._cycle_cached("statements", self._load_statements_snapshot)
+
+
+    def _load_statements_totals(self):
+        the_time, rs = self._statements_snapshot()
+        totals = {"ts": the_time}
+        for name in STATEMENTS_TOTALS + tuple("{}_calls".format(c) for c in self.classifier.names):
+            totals[name] = 0
+        for r in rs:
+            for name in STATEMENTS_TOTALS:
+                totals[name] += r[name] or 0
+            totals["{}_calls".format(self.classifier.get(r.queryid))] += r.calls or 0
+        return totals
+
+
+    def _statements_totals(self):
+        return self._cycle_cached("statements_totals", self._load_statements_totals)
+
+
+    def _statements_rates(self, key, columns):
+        totals = self._statements_totals()
+        return int(totals["ts"]), self.counters.rates(("statements", key), totals["ts"],
+                                                      [totals[c] for c in columns])
+
+
+    def _load_fanout_agents(self):
+        rspxy = self.execute_sql("""SELECT datname
+                                      FROM pg_database
+                                     WHERE datallowconn
+                                       AND NOT datistemplate
+                                       AND datname NOT IN ('contrib_regression', 'postgres', 'template0', 'template1')
+                                  ORDER BY datname """)
+        dbnames = [r[0] for r in rspxy.fetchall()]
+        # 已经删除的数据库不再保留
+        for dbname in set(self.relation_trackers) - set(dbnames):
+            del self.relation_trackers[dbname]
+        if len(dbnames) > self.dbs_per_cycle:
+            start = self.fanout_cursor % len(dbnames)
+            dbnames = (dbnames[start:] + dbnames[:start])[:self.dbs_per_cycle]
+            self.fanout_cursor = start + self.dbs_per_cycle
+        return [self.database_agents.get(dbname) for dbname in dbnames]
+
+
+    def _fan_out(self, method_name):
+        """本周期轮到的每个数据库各用自己的连接执行一次 method_name 。"""
+        rtn = []
+        for agent in self._cycle_cached("fanout_agents", self._load_fanout_agents):
+            if not agent.available():
+                continue
+            try:
+                rtn.extend(getattr(agent, method_name)())
+            except:
+                logger.error("Metric {} failed on database {}.".format(method_name, agent.cur_dbname))
+                logger.error(traceback.format_exc())
+        return rtn
+
+
     def _get_dbname(self):
         if self.first_run:
             rspxy = self.execute_sql("""SELECT current_database() """)
@@ -47,301 +522,286 @@ class PGAgent(object):
             self.first_run = False
 
 
+    def _refresh_database_sizes(self, dbnames, now):
+        """按上次测量的先后轮流重新计算超过 size_refresh_interval 的数据库的大小。
+
+        每次最多 size_dbs_per_cycle 个，未设置时按距上次调用的时间折算，使每个数据库大约每个刷新间隔测量一次；
+        首次调用视为已经过了一个刷新间隔，启动后所有数据库都有大小。
+        """
+        per_cycle = self.size_dbs_per_cycle
+        if per_cycle is None:
+            elapsed = now - self.size_last_run if self.size_last_run is not None else self.size_refresh_interval
+            per_cycle = max(int(math.ceil(len(dbnames) * elapsed / self.size_refresh_interval)), 1)
+        self.size_last_run = now
+        measured = sorted((self.db_sizes[d][1] if d in self.db_sizes else 0, d) for d in dbnames)
+        due = [d for at, d in measured if now - at >= self.size_refresh_interval][:per_cycle]
+        if not due:
+            return
+
+        if self.size_mode == "relpages":
+            # 由各库 pg_class 的 relpages 估算，不遍历数据目录，但只在 VACUUM/ANALYZE 后更新
+            for dbname in due:
+                try:
+                    agent = self.database_agents.get(dbname)
+                    if not agent.available():
+                        continue
+                    rs = agent.execute_sql(
+                        """SELECT SUM(relpages)::bigint * current_setting('block_size')::bigint
+                             FROM pg_class
+                            WHERE relkind IN ('r', 'i', 't', 'm', 'S') """).fetchone()
+                except:
+                    # 一个库连不上或查询失败不影响其它库，保留它上次的大小
+                    logger.error("Failed to estimate the size of database {}.".format(dbname))
+                    logger.error(traceback.format_exc())
+                    continue
+                if rs is not None:
+                    self.db_sizes[dbname] = (rs[0], time.time())
+        else:
+            rspxy = self.execute_sql("""SELECT datname
+                                             , pg_database_size(datname)
+                                          FROM pg_database
+                                         WHERE datname = ANY(:dbnames) """, {"dbnames": due})
+            measured_at = time.time()
+            for r in rspxy.fetchall():
+                self.db_sizes[r[0]] = (r[1], measured_at)
+
+
     def metric_database_size(self):
+        """每个周期只测量其中几个数据库，其余使用缓存的大小，另外发送该大小距今的秒数。"""
         rspxy = self.execute_sql("""SELECT datname
-                                         , extract(epoch from now())::int
-                                         , pg_database_size(datname)
                                       FROM pg_database
-                                     WHERE datname NOT IN ('contrib_regression', 'postgres', 'template1', 'template0')
-                                  ORDER BY pg_database_size(datname) DESC """)
-        rs = rspxy.fetchall()
+                                     WHERE datallowconn
+                                       AND datname NOT IN ('contrib_regression', 'postgres', 'template1', 'template0') """)
+        dbnames = [r[0] for r in rspxy.fetchall()]
+        now = time.time()
+        self._refresh_database_sizes(dbnames, now)
+        # 已经删除的数据库不再保留
+        for dbname in set(self.db_sizes) - set(dbnames):
+            del self.db_sizes[dbname]
+
         rtn = []
-        if rs is not None:
-            for r in rs:
-                rtn.append({"service": "database_size",
-                            "tags": [r[0]],
-                            "time": r[1],
-                            "metric": r[2]})
+        the_time = int(now)
+        for dbname in dbnames:
+            if dbname not in self.db_sizes:
+                continue
+            size, measured_at = self.db_sizes[dbname]
+            rtn.append(Event(service="database_size",
+                             tags=[dbname],
+                             time=the_time,
+                             metric=size))
+            rtn.append(Event(service="database_size_age",
+                             tags=[dbname],
+                             time=the_time,
+                             metric=max(now - measured_at, 0)))
         return rtn
 
 
     def metric_database_connections(self):
-        rspxy = self.execute_sql("""SELECT datname
-                                         , COUNT(1)
-                                      FROM pg_stat_activity
-                                  GROUP BY datname """)
-        rs = rspxy.fetchall()
+        the_time = self._session_snapshot()[0]
         rtn = []
-        if rs is not None:
-            for r in rs:
-                rtn.append({"service": "db_conns",
-                            "tags": ["db_connection", r[0]],
-                            "time": int(time.mktime(time.localtime())),
-                            "metric": r[1]})
+        for datname, cnt in self._count_sessions_by_db(lambda s: True).items():
+            rtn.append(Event(service="db_conns",
+                             tags=["db_connection", datname],
+                             time=the_time,
+                             metric=cnt))
         return rtn
 
 
     def metric_database_active_connections(self):
-        rspxy = self.execute_sql("""SELECT datname
-                                         , SUM(CASE WHEN state = 'active'
-                                                    THEN 1
-                                                    ELSE 0
-                                               END)
-                                      FROM pg_stat_activity
-                                  GROUP BY datname """)
-        rs = rspxy.fetchall()
+        the_time = self._session_snapshot()[0]
         rtn = []
-        if rs is not None:
-            for r in rs:
-                rtn.append({"service": "active_conns",
-                            "tags": ["db_connection", r[0]],
-                            "time": int(time.mktime(time.localtime())),
-                            "metric": r[1]})
+        for datname, cnt in self._count_sessions_by_db(lambda s: s.state == 'active').items():
+            rtn.append(Event(service="active_conns",
+                             tags=["db_connection", datname],
+                             time=the_time,
+                             metric=cnt))
         return rtn
 
 
     def metric_new_connections_in_5sec(self):
-        rspxy = self.execute_sql("""SELECT datname
-                                         , COUNT(1)
-                                      FROM pg_stat_activity
-                                     WHERE now()-backend_start <= '5 second'
-                                  GROUP BY datname""")
-        rs = rspxy.fetchall()
+        the_time = self._session_snapshot()[0]
+        counts = self._count_sessions_by_db(lambda s: s.backend_age is not None and s.backend_age <= 5)
         rtn = []
-        if rs is not None:
-            for r in rs:
-                rtn.append({"service": "new_conns_5s",
-                            "tags": ["db_connection", r[0]],
-                            "time": int(time.mktime(time.localtime())),
-                            "metric": r[1]})
+        for datname, cnt in counts.items():
+            if cnt == 0:
+                continue
+            rtn.append(Event(service="new_conns_5s",
+                             tags=["db_connection", datname],
+                             time=the_time,
+                             metric=cnt))
         return rtn
 
 
     def metric_max_connection_in_use(self):
-        rspxy = self.execute_sql("""SELECT COUNT(1)::float
-                                         / current_setting('max_connections')::float
-                                      FROM pg_stat_activity """)
-        rs = rspxy.fetchone()
+        the_time, max_conns, sessions = self._session_snapshot()
         rtn = []
-        if rs is not None:
-            rtn.append({"service": "max_connection_in_use",
-                        "time": int(time.mktime(time.localtime())),
-                        "metric": rs[0]})
+        if max_conns:
+            rtn.append(Event(service="max_connection_in_use",
+                             time=the_time,
+                             metric=len(sessions) / max_conns))
         return rtn
 
 
     def metric_index_hit_ratio(self):
+        if self.all_databases:
+            return self._fan_out("metric_index_hit_ratio")
         rspxy = self.execute_sql("""SELECT (SUM(idx_blks_hit) - SUM(idx_blks_read)) / CASE WHEN SUM(idx_blks_hit) = 0 THEN 1 ELSE SUM(idx_blks_hit) END
                                       FROM pg_statio_user_indexes """)
         rs = rspxy.fetchone()
         rtn = []
         if rs is not None:
             self._get_dbname()
-            rtn.append({"service": "index_hit_ratio",
-                        "time": int(time.mktime(time.localtime())),
-                        "tags": [self.cur_dbname],
-                        "metric": rs[0]})
+            rtn.append(Event(service="index_hit_ratio",
+                             time=int(time.mktime(time.localtime())),
+                             tags=[self.cur_dbname],
+                             metric=rs[0]))
         return rtn
 
 
     def metric_cache_hit_ratio(self):
+        if self.all_databases:
+            return self._fan_out("metric_cache_hit_ratio")
         rspxy = self.execute_sql("""SELECT SUM(heap_blks_hit) / CASE WHEN (SUM(heap_blks_hit) + SUM(heap_blks_read)) = 0 THEN 1 ELSE (SUM(heap_blks_hit) + SUM(heap_blks_read)) END
                                       FROM pg_statio_user_tables """)
         rs = rspxy.fetchone()
         rtn = []
         if rs is not None:
             self._get_dbname()
-            rtn.append({"service": "cache_hit_ratio",
-                        "time": int(time.mktime(time.localtime())),
-                        "tags": [self.cur_dbname],
-                        "metric": rs[0]})
+            rtn.append(Event(service="cache_hit_ratio",
+                             time=int(time.mktime(time.localtime())),
+                             tags=[self.cur_dbname],
+                             metric=rs[0]))
         return rtn
 
 
     def metric_qps(self):
-        rspxy = self.execute_sql("""WITH a AS (SELECT SUM(calls) s, SUM(CASE WHEN ltrim(query,' ') ~* '^select' THEN calls ELSE 0 END) q FROM pg_stat_statements),   
-                                         b AS (SELECT SUM(calls) s, SUM(CASE WHEN ltrim(query,' ') ~* '^select' THEN calls ELSE 0 END) q FROM pg_stat_statements , pg_sleep(1))   
-                                    SELECT b.s-a.s  AS QPS  
-                                         , b.q-a.q  AS RQPS  
-                                         , b.s-b.q-a.s+a.q  AS WQPS  
-                                      FROM a, b """)
-        rs = rspxy.fetchall()
+        classes = self.classifier.names
+        the_time, rates = self._statements_rates("qps", ["calls"] + ["{}_calls".format(c) for c in classes])
         rtn = []
-        if rs is not None:
-            for r in rs:
-                the_time = int(time.mktime(time.localtime()))
-                rtn.append({"service": "qps",
-                            "tags": ["qps"],
-                            "time": the_time,
-                            "metric": r[0]})
-                rtn.append({"service": "read_qps",
-                            "tags": ["qps"],
-                            "time": the_time,
-                            "metric": r[1]})
-                rtn.append({"service": "write_qps",
-                            "tags": ["qps"],
-                            "time": the_time,
-                            "metric": r[2]})
+        if rates is not None:
+            read_qps = rates[1 + classes.index("read")]
+            rtn.append(Event(service="qps",
+                             tags=["qps"],
+                             time=the_time,
+                             metric=rates[0]))
+            rtn.append(Event(service="read_qps",
+                             tags=["qps"],
+                             time=the_time,
+                             metric=read_qps))
+            rtn.append(Event(service="write_qps",
+                             tags=["qps"],
+                             time=the_time,
+                             metric=rates[0] - read_qps))
+            for name, rate in zip(classes, rates[1:]):
+                rtn.append(Event(service="class_qps",
+                                 tags=["qps", name],
+                                 time=the_time,
+                                 metric=rate))
         return rtn
 
 
     def metric_tps(self):
-        """两次结果之差除于时间间隔即为 TPS 。"""
-        # first
-        rspxy = self.execute_sql("""SELECT datname
-                                         , extract(epoch from now())::int AS ts
-                                         , xact_commit+xact_rollback      AS txn_num
-                                      FROM pg_catalog.pg_stat_database
-                                     WHERE datname NOT IN ('contrib_regression', 'postgres', 'template0', 'template1') """)
-        rs = rspxy.fetchall()
-        qa = {}
-        if rs is not None:
-            for r in rs:
-                qa[r[0]] = (r[1], r[2])
-
-        time.sleep(3)
-
-        # second
+        """与上一周期的累计事务数之差除于时间间隔即为 TPS 。"""
         rspxy = self.execute_sql("""SELECT datname
-                                         , extract(epoch from now())::int AS ts
-                                         , xact_commit+xact_rollback      AS txn_num
+                                         , extract(epoch from now())                       AS ts
+                                         , xact_commit+xact_rollback                       AS txn_num
+                                         , extract(epoch from pg_postmaster_start_time())  AS started
+                                         , extract(epoch from stats_reset)                 AS stats_reset
                                       FROM pg_catalog.pg_stat_database
                                      WHERE datname NOT IN ('contrib_regression', 'postgres', 'template0', 'template1') """)
         rs = rspxy.fetchall()
-        qb = {}
+        rtn = []
         if rs is not None:
             for r in rs:
-                qb[r[0]] = (r[1], r[2])
-
-        rtn = []
-        if qb is not None:
-            the_time =  int(time.mktime(time.localtime()))
-            for dbname, vals in qb.items():
-                last_txnnum = qa[dbname][1] if qa.get(dbname, None) is not None else vals[0]
-                last_txntim = qa[dbname][0] if qa.get(dbname, None) is not None else vals[1]-1
-                rtn.append({"service": "tps",
-                            "tags": [dbname],
-                            "time": the_time,
-                            "metric": (vals[1] - last_txnnum) / (vals[0] - last_txntim)})
+                tps = self.counters.rate(("tps", r[0]), r[1], r[2], (r[3], r[4]))
+                if tps is None:
+                    continue
+                rtn.append(Event(service="tps",
+                                 tags=[r[0]],
+                                 time=int(r[1]),
+                                 metric=tps))
         return rtn
 
 
     def metric_handled_rows_per_second(self):
-        rspxy = self.execute_sql("""WITH a AS (SELECT SUM(rows) AS rs FROM pg_stat_statements)
-                                       , b AS (SELECT SUM(rows) AS rs FROM pg_stat_statements, pg_sleep(1))
-                                    SELECT b.rs-a.rs
-                                      FROM a, b """)
-        rs = rspxy.fetchone()
+        the_time, rates = self._statements_rates("rows", ["rows"])
         rtn = []
-        if rs is not None:
-            rtn.append({"service": "handled_rows_per_second",
-                        "time": int(time.mktime(time.localtime())),
-                        "metric": rs[0]})
+        if rates is not None:
+            rtn.append(Event(service="handled_rows_per_second",
+                             time=the_time,
+                             metric=rates[0]))
         return rtn
 
 
     def metric_new_dirty_page_per_second(self):
-        rspxy = self.execute_sql("""WITH a AS (SELECT SUM(shared_blks_dirtied) AS rs, SUM(local_blks_dirtied) AS lrs FROM pg_stat_statements)
-                                       , b AS (SELECT SUM(shared_blks_dirtied) AS rs, SUM(local_blks_dirtied) AS lrs FROM pg_stat_statements, pg_sleep(1))
-                                    SELECT b.rs-a.rs
-                                         , b.lrs-a.lrs
-                                      FROM a, b """)
-        rs = rspxy.fetchone()
+        the_time, rates = self._statements_rates("dirtied", ["shared_dirtied", "local_dirtied"])
         rtn = []
-        if rs is not None:
-            the_time = int(time.mktime(time.localtime()))
-            rtn.append({"service": "new_dirty_page_per_second",
-                        "time": the_time, 
-                        "tags": ["shared_buffer"],
-                        "metric": rs[0]})
-            rtn.append({"service": "new_dirty_page_per_second",
-                        "time": the_time,
-                        "tags": ["local_buffer"],
-                        "metric": rs[1]})
+        if rates is not None:
+            rtn.append(Event(service="new_dirty_page_per_second",
+                             time=the_time,
+                             tags=["shared_buffer"],
+                             metric=rates[0]))
+            rtn.append(Event(service="new_dirty_page_per_second",
+                             time=the_time,
+                             tags=["local_buffer"],
+                             metric=rates[1]))
         return rtn
 
 
     def metric_write_dirty_page_per_second(self):
-        rspxy = self.execute_sql("""WITH a AS (SELECT SUM(shared_blks_written) AS rs, SUM(local_blks_written) AS lrs FROM pg_stat_statements)
-                                       , b AS (SELECT SUM(shared_blks_written) AS rs, SUM(local_blks_written) AS lrs FROM pg_stat_statements, pg_sleep(1))
-                                    SELECT b.rs-a.rs
-                                         , b.lrs-a.lrs
-                                      FROM a, b """)
-        rs = rspxy.fetchone()
+        the_time, rates = self._statements_rates("written", ["shared_written", "local_written"])
         rtn = []
-        if rs is not None:
-            the_time = int(time.mktime(time.localtime()))
-            rtn.append({"service": "write_dirty_page_per_second",
-                        "time": the_time,
-                        "tags": ["shared_buffer"],
-                        "metric": rs[0]})
-            rtn.append({"service": "write_dirty_page_per_second",
-                        "time": the_time,
-                        "tags": ["local_buffer"],
-                        "metric": rs[1]})
+        if rates is not None:
+            rtn.append(Event(service="write_dirty_page_per_second",
+                             time=the_time,
+                             tags=["shared_buffer"],
+                             metric=rates[0]))
+            rtn.append(Event(service="write_dirty_page_per_second",
+                             time=the_time,
+                             tags=["local_buffer"],
+                             metric=rates[1]))
         return rtn
 
 
     def metric_long_query_5sec(self):
-        rspxy = self.execute_sql("""SELECT usename
-                                         , datname
-                                         , pid
-                                      FROM pg_stat_activity
-                                     WHERE state='active'
-                                       AND query NOT LIKE 'autovacuum:%'
-                                       AND now()-query_start > interval '5 second' """)
-        rs = rspxy.fetchall()
+        the_time, _, sessions = self._session_snapshot()
         rtn = []
-        if rs is not None:
-            for r in rs:
-                rtn.append({"service": r[1],
-                            "time": int(time.mktime(time.localtime())),
-                            "tags": ["long_query_5sec", r[0]],
-                            "metric": r[2]})
+        for s in sessions:
+            if s.state == 'active' and s.user_query and s.query_age is not None and s.query_age > 5:
+                rtn.append(Event(service=s.datname,
+                                 time=the_time,
+                                 tags=["long_query_5sec", s.usename],
+                                 metric=s.pid))
         return rtn
 
 
     def metric_long_transaction_5sec(self):
-        rspxy = self.execute_sql("""SELECT COUNT(1)
-                                      FROM pg_stat_activity
-                                     WHERE state='active'
-                                       AND query NOT LIKE 'autovacuum:%'
-                                       AND now()-xact_start > interval '5 second' """)
-        rs = rspxy.fetchone()
-        rtn = []
-        if rs is not None:
-            rtn.append({"service": "long_transaction_5sec",
-                        "time": int(time.mktime(time.localtime())),
-                        "metric": rs[0]})
-        return rtn
+        the_time, _, sessions = self._session_snapshot()
+        cnt = 0
+        for s in sessions:
+            if s.state == 'active' and s.user_query and s.xact_age is not None and s.xact_age > 5:
+                cnt += 1
+        return [Event(service="long_transaction_5sec",
+                      time=the_time,
+                      metric=cnt)]
 
 
     def metric_long_idle_in_transaction_5sec(self):
-        rspxy = self.execute_sql("""SELECT COUNT(1)
-                                      FROM pg_stat_activity
-                                     WHERE state='idle in transaction'
-                                       AND query NOT LIKE 'autovacuum:%'
-                                       AND now()-state_change > interval '5 second' """)
-        rs = rspxy.fetchone()
-        rtn = []
-        if rs is not None:
-            rtn.append({"service": "long_idle_in_transaction_5sec",
-                        "time": int(time.mktime(time.localtime())),
-                        "metric": rs[0]})
-        return rtn
+        the_time, _, sessions = self._session_snapshot()
+        cnt = 0
+        for s in sessions:
+            if s.state == 'idle in transaction' and s.user_query and s.state_age is not None and s.state_age > 5:
+                cnt += 1
+        return [Event(service="long_idle_in_transaction_5sec",
+                      time=the_time,
+                      metric=cnt)]
 
 
     def metric_wait_session(self):
-        rspxy = self.execute_sql("""SELECT COUNT(1)
-                                      FROM pg_stat_activity
-                                     WHERE wait_event IS NOT NULL """)
-        rs = rspxy.fetchone()
-        rtn = []
-        if rs is not None:
-            rtn.append({"service": "wait_session",
-                        "time": int(time.mktime(time.localtime())),
-                        "metric": rs[0]})
-        return rtn
+        the_time, _, sessions = self._session_snapshot()
+        return [Event(service="wait_session",
+                      time=the_time,
+                      metric=sum(1 for s in sessions if s.waiting))]
 
 
     def metric_dead_lock_number(self):
@@ -350,9 +810,9 @@ class PGAgent(object):
         rs = rspxy.fetchone()
         rtn = []
         if rs is not None:
-            rtn.append({"service": "dead_lock_number",
-                        "time": int(time.mktime(time.localtime())),
-                        "metric": rs[0]})
+            rtn.append(Event(service="dead_lock_number",
+                             time=int(time.mktime(time.localtime())),
+                             metric=rs[0]))
         return rtn
 
 
@@ -368,18 +828,18 @@ class PGAgent(object):
         if rs is not None:
             for r in rs:
                 the_time = int(time.mktime(time.localtime()))
-                rtn.append({"service": "rows_update",
-                            "tags": ["rows_rdi", r[0]],
-                            "time": the_time,
-                            "metric": r[2]})
-                rtn.append({"service": "rows_insert",
-                            "tags": ["rows_rdi", r[0]],
-                            "time": the_time,
-                            "metric": r[3]})
-                rtn.append({"service": "rows_delete",
-                            "tags": ["rows_rdi", r[0]],
-                            "time": the_time,
-                            "metric": r[1]})
+                rtn.append(Event(service="rows_update",
+                                 tags=["rows_rdi", r[0]],
+                                 time=the_time,
+                                 metric=r[2]))
+                rtn.append(Event(service="rows_insert",
+                                 tags=["rows_rdi", r[0]],
+                                 time=the_time,
+                                 metric=r[3]))
+                rtn.append(Event(service="rows_delete",
+                                 tags=["rows_rdi", r[0]],
+                                 time=the_time,
+                                 metric=r[1]))
         return rtn
 
 
@@ -389,13 +849,15 @@ class PGAgent(object):
         rs = rspxy.fetchone()
         rtn = []
         if rs is not None:
-            rtn.append({"service": "replication_lag",
-                        "time": int(time.mktime(time.localtime())),
-                        "metric": int(rs[0])})
+            rtn.append(Event(service="replication_lag",
+                             time=int(time.mktime(time.localtime())),
+                             metric=int(rs[0])))
         return rtn
 
 
     def metric_seq_idx_scan(self):
+        if self.all_databases:
+            return self._fan_out("metric_seq_idx_scan")
         rspxy = self.execute_sql("""SELECT schemaname
                                          , SUM(COALESCE(seq_scan, 0))
                                          , SUM(COALESCE(idx_scan, 0))
@@ -409,52 +871,145 @@ class PGAgent(object):
             self._get_dbname()
             for r in rs:
                 the_time =  int(time.mktime(time.localtime()))
-                rtn.append({"service": "seq_scan",
-                            "tags": ["seq_idx_scan", r[0], self.cur_dbname],
-                            "time": the_time,
-                            "metric": r[1]})
-                rtn.append({"service": "idx_scan",
-                            "tags": ["seq_idx_scan", r[0], self.cur_dbname],
-                            "time": the_time,
-                            "metric": r[2]})
+                rtn.append(Event(service="seq_scan",
+                                 tags=["seq_idx_scan", r[0], self.cur_dbname],
+                                 time=the_time,
+                                 metric=r[1]))
+                rtn.append(Event(service="idx_scan",
+                                 tags=["seq_idx_scan", r[0], self.cur_dbname],
+                                 time=the_time,
+                                 metric=r[2]))
         return rtn
 
 
-    def metric_top10_long_query_in_db(self):
-        rspxy = self.execute_sql("""SELECT usename
-                                         , pid
-                                      FROM pg_stat_activity
-                                     WHERE datname = current_database()
-                                  ORDER BY now() - query_start DESC
-                                     LIMIT 10 """)
-        rs = rspxy.fetchall()
+    def metric_relation_stats(self):
+        """每个表的扫描、行数、块读写的每秒增量，只发送有变化的表，relation_stats_top_n 大于 0 时只发送增量最大的几个。"""
+        if self.all_databases:
+            return self._fan_out("metric_relation_stats")
+        self._get_dbname()
+        # 与 DatabaseAgents 一样按连接的数据库名区分
+        dbname = self.eng.url.database
+        relations = self.relation_trackers.get(dbname)
+        if relations is None:
+            relations = self.relation_trackers[dbname] = RelationTracker(self.relation_stats_max_entries)
+        relations.begin(time.time(), self.relation_stats_top_n)
+        for rows in self.stream_sql("""SELECT t.relid
+                                            , t.seq_scan
+                                            , t.seq_tup_read
+                                            , t.idx_scan
+                                            , t.idx_tup_fetch
+                                            , t.n_tup_ins
+                                            , t.n_tup_upd
+                                            , t.n_tup_del
+                                            , io.heap_blks_read
+                                            , io.heap_blks_hit
+                                            , io.idx_blks_read
+                                            , io.idx_blks_hit
+                                         FROM pg_stat_all_tables t
+                                         JOIN pg_statio_all_tables io ON io.relid = t.relid
+                                        WHERE t.schemaname NOT IN ('information_schema', 'pg_catalog', 'pg_toast') """,
+                                    self.relation_stats_batch):
+            relations.feed(rows)
+        changed = relations.finish()
+
         rtn = []
-        if rs is not None:
+        if changed:
+            names = self._relation_names([relid for relid, _ in changed])
+            the_time = int(time.time())
+            for relid, rates in changed:
+                tags = ["relation_stats", self.cur_dbname, names.get(relid, str(relid))]
+                for column, rate in zip(RELATION_COLUMNS, rates):
+                    rtn.append(Event(service="rel_" + column,
+                                     tags=tags,
+                                     time=the_time,
+                                     metric=rate))
+        return rtn
+
+
+    def _relation_names(self, relids):
+        """只为需要发送的表查询 schema.表名 ，缓存最多 relation_stats_max_entries 个。"""
+        missing = [relid for relid in relids if relid not in self.relation_names]
+        if missing:
+            if len(self.relation_names) + len(missing) > self.relation_stats_max_entries:
+                self.relation_names = {}
+            rspxy = self.execute_sql("""SELECT c.oid
+                                             , n.nspname || '.' || c.relname
+                                          FROM pg_class c
+                                          JOIN pg_namespace n ON n.oid = c.relnamespace
+                                         WHERE c.oid = ANY(:relids) """, {"relids": missing})
+            if rspxy is not None:
+                self.relation_names.update((r[0], r[1]) for r in rspxy.fetchall())
+        return self.relation_names
+
+
+    def metric_top10_long_query_in_db(self):
+        the_time, _, sessions = self._session_snapshot()
+        if self.all_databases:
+            # 快照中已经包含所有数据库的会话，不需要额外的连接
+            dbnames = set(s.datname for s in sessions if s.datname is not None)
+        else:
             self._get_dbname()
-            the_time =  int(time.mktime(time.localtime()))
-            for r in rs:
-                rtn.append({"service": "top10_long_query",
-                            "time": the_time,
-                            "tags": [r[0], self.cur_dbname],
-                            "metric": r[1]})
+            dbnames = [self.cur_dbname]
+
+        rtn = []
+        for dbname in dbnames:
+            in_db = [s for s in sessions if s.datname == dbname]
+            # 与 ORDER BY ... DESC 一致， query_start 为 NULL 的排在最前
+            in_db.sort(key=lambda s: (s.query_age is None, s.query_age or 0), reverse=True)
+            for s in in_db[:10]:
+                rtn.append(Event(service="top10_long_query",
+                                 time=the_time,
+                                 tags=[s.usename, dbname],
+                                 metric=s.pid))
         return rtn
 
 
-    def metric_top10_history_long_query_in_db(self):
-        rspxy = self.execute_sql("""SELECT pg_get_userbyid(userid)
-                                         , queryid
-                                      FROM pg_stat_statements
-                                     WHERE dbid = (SELECT oid FROM pg_database WHERE datname = current_database())
-                                  ORDER BY mean_time DESC
-                                  LIMIT 10 """)
-        rs = rspxy.fetchall()
+    def _server_version(self):
+        if self.server_version is None:
+            rs = self.execute_sql("""SELECT current_setting('server_version_num')::int """).fetchone()
+            if rs is not None:
+                self.server_version = rs[0]
+        return self.server_version
+
+
+    def _current_database_oid(self):
+        if self.cur_dboid is None:
+            rs = self.execute_sql("""SELECT oid FROM pg_database WHERE datname = current_database() """).fetchone()
+            if rs is not None:
+                self.cur_dboid = rs[0]
+        return self.cur_dboid
+
+
+    def _oid_names(self, kind, oid):
+        """dbid 、 userid 对应的名字，遇到未知的 oid 时重新读取一次。"""
+        names = self.oid_names.setdefault(kind, {})
+        if oid not in names:
+            if kind == "database":
+                rspxy = self.execute_sql("""SELECT oid, datname FROM pg_database """)
+            else:
+                rspxy = self.execute_sql("""SELECT oid, rolname FROM pg_roles """)
+            names.update((r[0], r[1]) for r in rspxy.fetchall())
+        return names.get(oid, str(oid))
+
+
+    def metric_top_statements(self):
+        """按本周期的增量（而非自统计开始的累计值）取耗时、调用次数、读写块数最多的语句。"""
+        the_time, rs = self._statements_snapshot()
+        if not self.all_databases:
+            # 只有 all_databases 时跟踪整个实例，否则只跟踪当前数据库
+            dboid = self._current_database_oid()
+            rs = [r for r in rs if r.dbid == dboid]
+        rs = [tuple(r)[:8] for r in rs if r.queryid is not None]
+        if self.statements is None:
+            self.statements = StatementsTracker(self.statements_max_entries)
+        tops = self.statements.update(the_time, rs, self.statements_top_n)
         rtn = []
-        if rs is not None:
-            self._get_dbname()
-            the_time =  int(time.mktime(time.localtime()))
-            for r in rs:
-                rtn.append({"service": "top10_his_long_query",
-                            "time": the_time,
-                            "tags": [r[0], self.cur_dbname],
-                            "metric": r[1]})
+        for (dbid, userid, queryid), rates in tops:
+            tags = ["top_statements", self._oid_names("user", userid), self._oid_names("database", dbid), str(queryid)]
+            for service, value in zip(("statement_calls", "statement_time_ms", "statement_rows",
+                                       "statement_blks_read", "statement_blks_written"), rates):
+                rtn.append(Event(service=service,
+                                 time=int(the_time),
+                                 tags=tags,
+                                 metric=value))
         return rtn
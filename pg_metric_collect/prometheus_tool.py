@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import re
+import time
+import logging
+import threading
+import http.server
+import socketserver
+import collections
+
+logger = logging.getLogger("pg_metric_collect")
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+INVALID_NAME_CHARS = re.compile(r"[^a-zA-Z0-9_:]")
+# 检查过期序列的最长间隔（秒）
+SWEEP_INTERVAL = 60
+
+
+def metric_name(service, prefix):
+    name = INVALID_NAME_CHARS.sub("_", service)
+    if prefix:
+        name = "{}_{}".format(prefix, name)
+    elif name[:1].isdigit():
+        name = "_" + name
+    return name
+
+
+def label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_value(value):
+    value = float(value)
+    if value != value:
+        return "NaN"
+    if value in (float("inf"), float("-inf")):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(value)
+
+
+class MetricSnapshot(object):
+    """每个序列 (host, service, tags) 的最新值，按 Prometheus 文本格式预先渲染。
+
+    update 只重新渲染取值变化了的序列；每个指标名的文本单独缓存，抓取时只重新拼接有变化的指标名。
+    带有 ttl 的事件（例如 DedupStage 输出的）超过 ttl 秒没有更新时不再输出，其它序列为 expire 秒，
+    expire 应大于最长的采集间隔。
+    """
+    def __init__(self, prefix="pg_metric_collect", default_host=None, expire=300):
+        self.prefix = prefix
+        self.default_host = default_host
+        self.expire = expire
+        self.lock = threading.Lock()
+        # 指标名 -> {序列: [取值, 渲染好的一行, 过期时间]}，同名的序列在输出中必须相邻
+        self.families = collections.OrderedDict()
+        # 序列 -> (指标名, 行首的 name{labels} )
+        self.heads = {}
+        # 指标名 -> 该指标名渲染好的文本
+        self.texts = {}
+        # 有变化的指标名
+        self.dirty = set()
+        self.body = b""
+        self.sweep_interval = min(expire, SWEEP_INTERVAL)
+        self.sweep_due = time.time() + self.sweep_interval
+
+
+    def _head(self, key):
+        try:
+            return self.heads[key]
+        except KeyError:
+            pass
+        host, service, tags = key
+        name = metric_name(service, self.prefix)
+        labels = []
+        if host is not None:
+            labels.append("host=\"{}\"".format(label_value(host)))
+        if tags:
+            labels.append("tags=\"{}\"".format(label_value(",".join(str(t) for t in tags))))
+        head = "{}{{{}}} ".format(name, ",".join(labels)) if labels else name + " "
+        rtn = self.heads[key] = (name, head)
+        return rtn
+
+
+    def update(self, events):
+        now = time.time()
+        with self.lock:
+            for event in events:
+                if event.metric is None:
+                    continue
+                key = (event.host if event.host is not None else self.default_host, event.service, event.tags)
+                try:
+                    name, head = self._head(key)
+                    family = self.families.get(name)
+                    if family is None:
+                        family = self.families[name] = {}
+                    expires_at = now + (event.ttl or self.expire)
+                    series = family.get(key)
+                    if series is not None and series[0] == event.metric:
+                        series[2] = expires_at
+                        continue
+                    family[key] = [event.metric, head + format_value(event.metric) + "\n", expires_at]
+                except (TypeError, ValueError):
+                    logger.debug("Skip event {!r} for the Prometheus endpoint.".format(event))
+                    continue
+                self.dirty.add(name)
+            if now >= self.sweep_due:
+                self._sweep(now)
+
+
+    def _sweep(self, now):
+        for name, family in list(self.families.items()):
+            for key in [key for key, series in family.items() if now > series[2]]:
+                del family[key]
+                del self.heads[key]
+                self.dirty.add(name)
+            if not family:
+                del self.families[name]
+        self.sweep_due = now + self.sweep_interval
+
+
+    def render(self):
+        with self.lock:
+            if self.dirty:
+                for name in self.dirty:
+                    family = self.families.get(name)
+                    if family is None:
+                        self.texts.pop(name, None)
+                        continue
+                    parts = ["# TYPE {} gauge\n".format(name)]
+                    parts.extend(series[1] for series in family.values())
+                    self.texts[name] = "".join(parts).encode("utf-8")
+                self.body = b"".join(self.texts[name] for name in self.families)
+                self.dirty = set()
+            return self.body
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """http.server.ThreadingHTTPServer 要求 Python 3.7 。"""
+    daemon_threads = True
+
+
+class PrometheusExporter(object):
+    """在 Sender 进程中的一个线程里提供 /metrics ，内容来自 MetricSnapshot ，抓取时不查询数据库。"""
+    def __init__(self, port, bind="0.0.0.0", snapshot=None):
+        self.port = port
+        self.bind = bind
+        self.snapshot = snapshot or MetricSnapshot()
+        self.server = None
+
+
+    def update(self, events):
+        self.snapshot.update(events)
+
+
+    def start(self):
+        snapshot = self.snapshot
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?", 1)[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = snapshot.render()
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, fmt, *args):
+                logger.debug("Prometheus endpoint: " + fmt % args)
+
+        self.server = ThreadingHTTPServer((self.bind, self.port), Handler)
+        thread = threading.Thread(target=self.server.serve_forever, name="PrometheusExporter")
+        thread.daemon = True
+        thread.start()
+        logger.info("Serve Prometheus metrics on {}:{}/metrics".format(self.bind, self.port))
+        return self
+
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import os
+import time
+import zlib
+import bisect
+import pickle
+import struct
+import logging
+import threading
+import collections
+
+from pg_metric_collect.postgresql_tool import QueryResult
+
+logger = logging.getLogger("pg_metric_collect")
+
+MAGIC = b"PGMCREC1"
+FRAME_HEADER = struct.Struct("!I")
+
+FRAME_SQL = 0
+FRAME_RESULT = 1
+
+
+def row_type(columns):
+    """与 SQLAlchemy 的结果行一样，可以按位置、列名或属性取值。"""
+    base = collections.namedtuple("Row", columns, rename=True)
+
+    class Row(base):
+        __slots__ = ()
+
+        def __getitem__(self, key):
+            if isinstance(key, str):
+                return getattr(self, key)
+            return base.__getitem__(self, key)
+
+    return Row
+
+
+class QueryRecorder(object):
+    """把每次查询的结果集按列存储，连同时间戳追加写入文件，每帧单独 pickle 并 zlib 压缩。
+
+    SQL 文本只在第一次出现时写入一次，之后用编号引用。文件超过 max_bytes 后停止记录。
+    path 已经存在时改写到 path.<时间戳> ，不覆盖之前的录制。
+    """
+    def __init__(self, path, max_bytes=1 << 30):
+        if os.path.exists(path):
+            path = "{}.{}".format(path, int(time.time()))
+        logger.info("Record query results to {}.".format(path))
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.sql_ids = {}
+        self.f = open(path, "wb")
+        self.f.write(MAGIC)
+        # 采集进程由 fork 产生，缓冲区里未写出的内容会在每个进程退出时各写一次
+        self.f.flush()
+        self.size = len(MAGIC)
+        self.full = False
+
+
+    def _write(self, frame):
+        data = zlib.compress(pickle.dumps(frame, protocol=pickle.HIGHEST_PROTOCOL))
+        self.f.write(FRAME_HEADER.pack(len(data)) + data)
+        self.size += FRAME_HEADER.size + len(data)
+
+
+    def record(self, database, sql_str, result):
+        if self.full:
+            return
+        ts = time.time()
+        columns = tuple(result.columns or ())
+        data = tuple(zip(*result.rows)) if result.rows else ()
+        with self.lock:
+            sql_id = self.sql_ids.get(sql_str)
+            if sql_id is None:
+                sql_id = self.sql_ids[sql_str] = len(self.sql_ids)
+                self._write((FRAME_SQL, sql_id, sql_str))
+            self._write((FRAME_RESULT, sql_id, database, ts, columns, data))
+            self.f.flush()
+            if self.size >= self.max_bytes:
+                logger.warn("Record file {} reached {} bytes, stop recording.".format(self.path, self.max_bytes))
+                self.full = True
+                self.f.close()
+
+
+def read_frames(path):
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("{} is not a pg_metric_collect record file.".format(path))
+        while True:
+            header = f.read(FRAME_HEADER.size)
+            if len(header) < FRAME_HEADER.size:
+                return
+            data = f.read(FRAME_HEADER.unpack(header)[0])
+            try:
+                yield pickle.loads(zlib.decompress(data))
+            except (zlib.error, EOFError, pickle.UnpicklingError):
+                logger.warn("Truncated frame in record file {}, ignore the rest.".format(path))
+                return
+
+
+class ReplayBackend(object):
+    """按 QueryRecorder 录制的文件返回查询结果，可代替 PGAgent 的数据库连接。
+
+    speed > 0 时按录制时的时间线回放（speed 为倍速），返回录制时钟当前时刻之前最近的一次结果；
+    speed 为 0 时每次查询依次返回同一 SQL 的下一次结果。录制的结果用完后从头开始。
+    连接的数据库不在录制文件中时，使用录制时第一个查询的数据库的结果。
+    """
+    def __init__(self, path, speed=1.0):
+        self.path = path
+        self.speed = speed
+        self.lock = threading.Lock()
+        sqls = {}
+        self.results = collections.defaultdict(list)
+        self.databases = set()
+        self.main_database = None
+        for frame in read_frames(path):
+            if frame[0] == FRAME_SQL:
+                sqls[frame[1]] = frame[2]
+            else:
+                _, sql_id, database, ts, columns, data = frame
+                self.results[(database, sqls[sql_id])].append((ts, columns, data))
+                if self.main_database is None:
+                    self.main_database = database
+                self.databases.add(database)
+        self.timestamps = dict((key, [r[0] for r in results]) for key, results in self.results.items())
+        all_ts = [ts for stamps in self.timestamps.values() for ts in stamps]
+        self.first_ts = min(all_ts) if all_ts else 0
+        self.span = (max(all_ts) - self.first_ts) if all_ts else 0
+        self.cursors = {}
+        self.row_types = {}
+        self.anchor = None
+        self.unknown = set()
+        logger.info("Loaded {} recorded result(s) of {} queries from {}.".format(
+            len(all_ts), len(self.results), path))
+
+
+    def _pick(self, key):
+        results = self.results[key]
+        if self.speed > 0:
+            now = time.time()
+            if self.anchor is None:
+                self.anchor = now
+            elapsed = (now - self.anchor) * self.speed
+            if self.span > 0:
+                elapsed %= self.span
+            index = bisect.bisect_right(self.timestamps[key], self.first_ts + elapsed) - 1
+            return results[max(index, 0)]
+        index = self.cursors.get(key, 0)
+        self.cursors[key] = (index + 1) % len(results)
+        return results[index]
+
+
+    def execute(self, sql_str, params=None, database=None):
+        if database not in self.databases:
+            database = self.main_database
+        key = (database, sql_str)
+        with self.lock:
+            if key not in self.results:
+                if key not in self.unknown:
+                    self.unknown.add(key)
+                    logger.warn("No recorded result for SQL on database {}: {}".format(
+                        database, " ".join(sql_str.split())))
+                return QueryResult([], [])
+            ts, columns, data = self._pick(key)
+            if columns not in self.row_types:
+                self.row_types[columns] = row_type(columns) if columns else tuple
+        make_row = self.row_types[columns]
+        if make_row is tuple:
+            return QueryResult([tuple(r) for r in zip(*data)], columns)
+        return QueryResult([make_row(*r) for r in zip(*data)], columns)
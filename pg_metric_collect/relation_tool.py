@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import heapq
+import logging
+
+import numpy
+
+from pg_metric_collect.counter_tool import SlotTable
+
+logger = logging.getLogger("pg_metric_collect")
+
+# 与 PGAgent 中查询 pg_stat_all_tables / pg_statio_all_tables 的列顺序一致（第一列为 relid）
+COLUMNS = ("seq_scan", "seq_tup_read", "idx_scan", "idx_tup_fetch",
+           "n_tup_ins", "n_tup_upd", "n_tup_del",
+           "heap_blks_read", "heap_blks_hit", "idx_blks_read", "idx_blks_hit")
+# 取前 N 个时按这些列的增量之和排序：读写的行数以及从磁盘读入的块数
+WEIGHT_COLUMNS = [COLUMNS.index(c) for c in ("seq_tup_read", "idx_tup_fetch", "n_tup_ins", "n_tup_upd",
+                                             "n_tup_del", "heap_blks_read", "idx_blks_read")]
+
+
+class RelationTracker(object):
+    """按 relid 保存每个表上一次的累计计数器，分批接收一次完整的扫描，只返回计数器有变化的表。
+
+    累计值存放在 SlotTable 中，每个表占一行，表的数量超过 max_entries 时新表不再跟踪；
+    本次扫描中没有出现的表（已经删除）归还所占的行。top_n 大于 0 时只保留增量最大的 top_n 个表，
+    扫描过程中用一个大小为 top_n 的堆筛选，不需要保存所有变化的表。
+    """
+    def __init__(self, max_entries=200000):
+        self.max_entries = max_entries
+        # relid -> 行
+        self.table = SlotTable(len(COLUMNS), max_entries, "relations")
+        self.last_ts = None
+        self.elapsed = None
+        self.top_n = 0
+        self.changed = []
+
+
+    def begin(self, ts, top_n=0):
+        self.table.next_generation()
+        self.elapsed = ts - self.last_ts if self.last_ts is not None else None
+        self.last_ts = ts
+        self.top_n = top_n
+        self.changed = []
+
+
+    def feed(self, rows):
+        """rows 为一批 (relid, 按 COLUMNS 顺序的累计值...) 。"""
+        if not rows:
+            return
+        relids = [r[0] for r in rows]
+        slots, known = self.table.slots(relids)
+        current = numpy.array([r[1:] for r in rows], dtype=float).reshape(len(rows), len(COLUMNS))
+        # 统计视图中没有数据的列为 NULL
+        current = numpy.nan_to_num(current)
+        deltas = current - self.table.values[slots]
+        tracked = self.table.store(slots, current)
+        # 计数器回退（pg_stat_reset() 等）时只记录本次的值
+        changed = known & tracked & (deltas >= 0).all(axis=1) & (deltas > 0).any(axis=1)
+        if not self.elapsed or self.elapsed <= 0:
+            return
+
+        weights = deltas[:, WEIGHT_COLUMNS].sum(axis=1)
+        for i in numpy.flatnonzero(changed):
+            item = (weights[i], relids[i], deltas[i])
+            if not self.top_n:
+                self.changed.append(item)
+            elif len(self.changed) < self.top_n:
+                heapq.heappush(self.changed, item)
+            elif item[0] > self.changed[0][0]:
+                heapq.heapreplace(self.changed, item)
+
+
+    def finish(self):
+        """结束本次扫描，返回 [(relid, 每秒增量)] ，按增量从大到小排列，首次扫描返回空列表。"""
+        self.table.evict()
+        changed = sorted(self.changed, key=lambda item: item[0], reverse=True)
+        self.changed = []
+        if not self.elapsed or self.elapsed <= 0:
+            return []
+        return [(relid, tuple(float(v) / self.elapsed for v in deltas)) for _, relid, deltas in changed]
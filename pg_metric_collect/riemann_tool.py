@@ -5,34 +5,411 @@
 import bernhard
 import traceback
 import logging
+import time
+import socket
+import struct
+import threading
+import collections
+
+from bernhard import pb
+
+from pg_metric_collect.event import Event
+from pg_metric_collect.event import EventEncoder
+from pg_metric_collect.instrument import Instruments
 
 logger = logging.getLogger("pg_metric_collect")
 
+# 重放时每条消息最多包含的事件数
+REPLAY_BATCH = 500
+
+TRANSPORTS = ("tcp", "pipelined", "udp")
+MODES = ("failover", "spread")
+
+FRAME_HEADER = struct.Struct("!I")
+# Riemann 默认接收的 UDP 包大小上限
+UDP_MAX_SIZE = 16384
+CONNECT_TIMEOUT = 5
+# 停止时等待在途消息确认的时间
+CLOSE_TIMEOUT = 5
+
+
+class Transport(object):
+    """一个 Riemann 地址。发送失败后的 retry_interval 秒内视为不可用。"""
+    def __init__(self, host, port, retry_interval=5):
+        self.host = host
+        self.port = int(port)
+        self.retry_interval = retry_interval
+        self.down_until = 0
+
+    def __repr__(self):
+        return "{}({}:{})".format(self.__class__.__name__, self.host, self.port)
+
+    def available(self):
+        return time.time() >= self.down_until
+
+    def mark_down(self):
+        self.down_until = time.time() + self.retry_interval
+
+    def transmit(self, encoder, raw_events, instruments):
+        """成功送出（或被 Riemann 明确拒绝）时返回 True 。"""
+        raise NotImplementedError
+
+    def drain_failed(self):
+        """已经接受但最终没有送达的事件，由调用方写入 spool 。"""
+        return []
+
+    def close(self):
+        pass
+
+
+class TCPTransport(Transport):
+    """每条消息等待 Riemann 确认后再发送下一条。"""
+    def __init__(self, host, port, retry_interval=5):
+        super(TCPTransport, self).__init__(host, port, retry_interval)
+        self.client = bernhard.Client(host=host, port=self.port)
+
+    def transmit(self, encoder, raw_events, instruments):
+        try:
+            started = time.time()
+            response = self.client.transmit(encoder.message(raw_events))
+            # 从写出消息到收到 Riemann 确认的耗时
+            instruments.record("send_seconds", time.time() - started)
+            if response.ok:
+                return True
+            if response.error:
+                logger.error("Riemann {} rejected {} event(s): {}".format(self, len(raw_events), response.error))
+                return True
+            logger.warn("Riemann {} did not acknowledge the message.".format(self))
+        except bernhard.TransportError:
+            logger.warn("Could not open TCP socket to {}.".format(self))
+        except:
+            logger.error(traceback.format_exc())
+        return False
+
+
+class UDPTransport(Transport):
+    """不等待确认，适合可以容忍丢失的高频序列。消息按 max_size 拆分。"""
+    def __init__(self, host, port, retry_interval=5, max_size=UDP_MAX_SIZE):
+        super(UDPTransport, self).__init__(host, port, retry_interval)
+        self.max_size = max_size
+        self.sock = None
+
+    def _chunks(self, raw_events):
+        chunk, size = [], 0
+        for raw in raw_events:
+            # 每个事件另有 1 字节的字段号和至多 3 字节的长度
+            if chunk and size + len(raw) + 4 > self.max_size:
+                yield chunk
+                chunk, size = [], 0
+            chunk.append(raw)
+            size += len(raw) + 4
+        if chunk:
+            yield chunk
+
+    def transmit(self, encoder, raw_events, instruments):
+        try:
+            if self.sock is None:
+                family, socktype, proto, _, address = socket.getaddrinfo(self.host, self.port, 0,
+                                                                         socket.SOCK_DGRAM)[0]
+                self.sock = socket.socket(family, socktype, proto)
+                self.sock.connect(address)
+            for chunk in self._chunks(raw_events):
+                self.sock.send(encoder.message(chunk).raw)
+            return True
+        except OSError as e:
+            logger.warn("Could not send UDP datagram to {}: {}".format(self, e))
+            self.close()
+            return False
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+class PipelinedTCPTransport(Transport):
+    """不等待确认就发送下一条消息，最多 max_in_flight 条在途，确认由读线程按顺序匹配。
+
+    连接断开时仍未确认的消息通过 drain_failed 交还调用方。
+    """
+    def __init__(self, host, port, retry_interval=5, max_in_flight=8, ack_timeout=10):
+        super(PipelinedTCPTransport, self).__init__(host, port, retry_interval)
+        self.max_in_flight = max(max_in_flight, 1)
+        self.ack_timeout = ack_timeout
+        self.cond = threading.Condition()
+        self.sock = None
+        # 在途消息： (事件, 发送时间)
+        self.pending = collections.deque()
+        self.failed = []
+        self.instruments = None
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=CONNECT_TIMEOUT)
+        sock.settimeout(None)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock = sock
+        reader = threading.Thread(target=self._read_acks, args=(sock,), name="RiemannAcks")
+        reader.daemon = True
+        reader.start()
+
+    def _read_exactly(self, sock, size):
+        buf = b""
+        while len(buf) < size:
+            data = sock.recv(size - len(buf))
+            if not data:
+                raise EOFError("Riemann {} closed the connection.".format(self))
+            buf += data
+        return buf
+
+    def _read_acks(self, sock):
+        try:
+            while True:
+                header = self._read_exactly(sock, FRAME_HEADER.size)
+                response = pb.Msg.FromString(self._read_exactly(sock, FRAME_HEADER.unpack(header)[0]))
+                with self.cond:
+                    if not self.pending:
+                        continue
+                    raw_events, sent_at = self.pending.popleft()
+                    self.cond.notify_all()
+                if self.instruments is not None:
+                    self.instruments.record("send_seconds", time.time() - sent_at)
+                if not response.ok and response.error:
+                    logger.error("Riemann {} rejected {} event(s): {}".format(self, len(raw_events), response.error))
+        except (OSError, EOFError, ValueError) as e:
+            with self.cond:
+                if self.sock is sock:
+                    logger.warn("Lost pipelined connection to {}: {}".format(self, e))
+                    self._fail()
+
+    def _fail(self):
+        """调用时持有 self.cond 。"""
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+        self.failed.extend(raw_events for raw_events, _ in self.pending)
+        self.pending.clear()
+        self.mark_down()
+        self.cond.notify_all()
+
+    def transmit(self, encoder, raw_events, instruments):
+        self.instruments = instruments
+        frame = encoder.message(raw_events).raw
+        with self.cond:
+            try:
+                if self.sock is None:
+                    self._connect()
+                deadline = time.time() + self.ack_timeout
+                while len(self.pending) >= self.max_in_flight and self.sock is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        logger.warn("Riemann {} did not acknowledge in {}s.".format(self, self.ack_timeout))
+                        self._fail()
+                        return False
+                    self.cond.wait(remaining)
+                if self.sock is None:
+                    return False
+                self.sock.sendall(FRAME_HEADER.pack(len(frame)) + frame)
+                self.pending.append((raw_events, time.time()))
+                return True
+            except OSError as e:
+                logger.warn("Could not send to {}: {}".format(self, e))
+                self._fail()
+                return False
+
+    def drain_failed(self):
+        with self.cond:
+            failed, self.failed = self.failed, []
+        return failed
+
+    def close(self):
+        """等待在途消息确认，超时后仍未确认的消息留给 drain_failed 。"""
+        deadline = time.time() + CLOSE_TIMEOUT
+        with self.cond:
+            while self.pending and self.sock is not None and time.time() < deadline:
+                self.cond.wait(deadline - time.time())
+            sock, self.sock = self.sock, None
+            self.failed.extend(raw_events for raw_events, _ in self.pending)
+            self.pending.clear()
+        if sock is not None:
+            sock.close()
+
+
+class EndpointGroup(object):
+    """一组 Riemann 地址。 failover 总是优先使用第一个可用的地址， spread 在可用的地址间轮流发送。
+
+    发送失败的地址在 retry_interval 秒内不再使用，之后的第一次发送即为对它的检查。
+    """
+    def __init__(self, transports, mode="failover"):
+        if mode not in MODES:
+            raise ValueError("Unknown riemann mode {!r}, expect one of {}.".format(mode, ", ".join(MODES)))
+        self.transports = transports
+        self.mode = mode
+        self.cursor = 0
+
+    def available(self):
+        return any(t.available() for t in self.transports)
+
+    def transmit(self, encoder, raw_events, instruments):
+        transports = self.transports
+        if self.mode == "spread":
+            start = self.cursor % len(transports)
+            self.cursor = start + 1
+            transports = transports[start:] + transports[:start]
+        for transport in transports:
+            if not transport.available():
+                continue
+            if transport.transmit(encoder, raw_events, instruments):
+                return True
+            instruments.incr("send_failures", ("{}:{}".format(transport.host, transport.port),))
+            transport.mark_down()
+        return False
+
+    def drain_failed(self):
+        failed = []
+        for transport in self.transports:
+            failed.extend(transport.drain_failed())
+        return failed
+
+    def close(self):
+        for transport in self.transports:
+            transport.close()
+
+
+def make_transport(kind, host, port, retry_interval=5, **options):
+    if kind == "tcp":
+        return TCPTransport(host, port, retry_interval)
+    if kind == "udp":
+        return UDPTransport(host, port, retry_interval, max_size=options.get("max_size", UDP_MAX_SIZE))
+    if kind == "pipelined":
+        return PipelinedTCPTransport(host, port, retry_interval, max_in_flight=options.get("max_in_flight", 8))
+    raise ValueError("Unknown riemann transport {!r}, expect one of {}.".format(kind, ", ".join(TRANSPORTS)))
+
 
 class EventAgent(object):
-    def __init__(self, rm_tcp_host, rm_tcp_port, this_host):
-        logger.debug("Use remote riemman uri: {}:{}".format(rm_tcp_host, rm_tcp_port))
-        self.client = bernhard.Client(host=rm_tcp_host, port=rm_tcp_port)
+    """transport 为默认的 EndpointGroup ，未指定时使用 rm_tcp_host:rm_tcp_port 的同步 TCP 连接。
+
+    routes 为 [(service 正则, EndpointGroup)] ，事件按第一个匹配的 service 正则选择发送的地址组。
+    """
+    def __init__(self, rm_tcp_host, rm_tcp_port, this_host, spool=None, retry_interval=5, replay_rate=1000,
+                 instruments=None, transport=None, routes=None):
+        if transport is None:
+            logger.debug("Use remote riemman uri: {}:{}".format(rm_tcp_host, rm_tcp_port))
+            transport = EndpointGroup([TCPTransport(rm_tcp_host, rm_tcp_port, retry_interval)])
+        self.transport = transport
+        self.routes = routes or []
+        self.route_cache = {}
         logger.debug("Tag this worker by host={}".format(this_host))
         self.this_host = this_host
+        self.encoder = EventEncoder()
+        self.instruments = instruments or Instruments(0)
+
+        # Riemann 不可达时事件写入 spool ，恢复后经默认地址组以每秒最多 replay_rate 个的速度重放
+        self.spool = spool
+        self.replay_rate = replay_rate
+        self.replay_allowance = 0
+        self.replay_checked = time.time()
 
     def send(self, msg):
-        if not isinstance(msg, dict):
-            raise TypeError("Method `send` require a dict as input parameter.")
-        msg.update({"host": self.this_host})
+        self.send_batch([msg])
+
+    def _route(self, service):
         try:
-            logger.debug("Sending message => {!s}".format(msg))
-            self.client.send(msg)
-        except bernhard.TransportError:
-            logger.warn("Could not open TCP socket.")
-        except:
-            logger.error(msg)
-            logger.error(traceback.format_exc())
+            return self.route_cache[service]
+        except KeyError:
+            pass
+        group = self.transport
+        for pattern, route in self.routes:
+            if pattern.search(service):
+                group = route
+                break
+        self.route_cache[service] = group
+        return group
+
+    def _spool(self, raw_events):
+        if self.spool is None:
+            logger.warn("Drop {} unacknowledged event(s).".format(len(raw_events)))
+            self.instruments.incr("sender_dropped_events", ("unacknowledged",), value=len(raw_events))
+            return
+        try:
+            self.spool.append(raw_events)
+        except (IOError, OSError):
+            # 磁盘满、没有权限或只读时丢弃这些事件，不能让发送线程退出
+            logger.error("Drop {} event(s), can not write them to the spool: {}".format(
+                len(raw_events), traceback.format_exc()))
+            self.instruments.incr("sender_dropped_events", ("spool",), value=len(raw_events))
+
+    def _spool_failed(self):
+        for group in [self.transport] + [route for _, route in self.routes]:
+            for raw_events in group.drain_failed():
+                self._spool(raw_events)
+
+    def _transmit(self, raw_events, group=None):
+        logger.debug("Sending {} message(s) in one batch.".format(len(raw_events)))
+        return (group or self.transport).transmit(self.encoder, raw_events, self.instruments)
+
+    def send_batch(self, msgs):
+        batches = collections.OrderedDict()
+        for msg in msgs:
+            if not isinstance(msg, Event):
+                raise TypeError("Method `send` require an Event as input parameter.")
+            try:
+                raw = self.encoder.encode(msg, self.this_host)
+            except:
+                # 一个坏事件不应拖累整批，只丢弃它自己
+                logger.error(msg)
+                logger.error(traceback.format_exc())
+                continue
+            group = self._route(msg.service) if self.routes else self.transport
+            batches.setdefault(id(group), (group, []))[1].append(raw)
+
+        for group, raw_events in batches.values():
+            if not self._transmit(raw_events, group) and self.spool is not None:
+                self._spool(raw_events)
+        self._spool_failed()
+
+    def replay(self):
+        """限速重放 spool 中的事件，返回是否还有待重放的事件。"""
+        self._spool_failed()
+        if self.spool is None or not self.spool.pending():
+            return False
+
+        now = time.time()
+        self.replay_allowance = min(self.replay_allowance + (now - self.replay_checked) * self.replay_rate,
+                                    self.replay_rate)
+        self.replay_checked = now
+        if not self.transport.available() or self.replay_allowance < 1:
+            return True
+
+        try:
+            raws, position = self.spool.read(int(min(self.replay_allowance, REPLAY_BATCH)))
+        except (IOError, OSError):
+            logger.error("Can not read the spool: {}".format(traceback.format_exc()))
+            return True
+        if raws:
+            if not self._transmit(raws):
+                return True
+            self.replay_allowance -= len(raws)
+            logger.debug("Replayed {} spooled event(s).".format(len(raws)))
+        try:
+            self.spool.commit(position)
+        except (IOError, OSError):
+            # 位置没有保存下来，重启后这些事件会再重放一次
+            logger.error("Can not save the spool replay offset: {}".format(traceback.format_exc()))
+        return self.spool.pending()
+
+    def close(self):
+        """等待在途的消息，没有送达的写入 spool 。"""
+        for group in [self.transport] + [route for _, route in self.routes]:
+            group.close()
+        self._spool_failed()
 
 
 if __name__ == "__main__":
     testc = EventAgent("127.0.0.1", 5555, "test_local")
-    testc.send({"service": "test_message",
-                "state": "ok",
-                "tags": ["indicator_1a"],
-                "metric": 13.34})
+    testc.send(Event(service="test_message",
+                     tags=["indicator_1a"],
+                     time=int(time.time()),
+                     metric=13.34))
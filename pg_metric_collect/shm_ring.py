@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import os
+import time
+import queue
+import pickle
+import struct
+import logging
+import multiprocessing
+from multiprocessing import shared_memory
+
+from pg_metric_collect.event import Event
+
+logger = logging.getLogger("pg_metric_collect")
+
+# head, tail, 经 overflow 队列传递、尚未取出的事件数
+RING_HEADER = struct.Struct("=QQQ")
+RECORDS_OFFSET = RING_HEADER.size
+# flags, service, tags, host, time, metric, enqueued_at, ttl
+RECORD = struct.Struct("=BIIIdddf")
+# count, used
+TABLE_HEADER = struct.Struct("=IQ")
+ENTRY_HEADER = struct.Struct("=I")
+
+FLAG_METRIC = 1
+FLAG_METRIC_INT = 2
+FLAG_TIME = 4
+FLAG_TIME_INT = 8
+
+POLL_MIN = 0.0005
+POLL_MAX = 0.01
+# overflow 队列的事件由生产者的后台线程写入管道，计数先于事件可见时最多等待这么多秒
+OVERFLOW_WAIT = 1
+# 等待 StringTable 锁的最长时间。持有锁的进程可能已被 SIGKILL ，之后的调用不应永远阻塞
+LOCK_TIMEOUT = 1
+
+
+def acquire(lock, block=True, deadline=None):
+    """deadline 为 None 且 block 时一直等待。"""
+    if not block:
+        return lock.acquire(False)
+    if deadline is None:
+        return lock.acquire()
+    return lock.acquire(timeout=max(deadline - time.time(), 0))
+
+
+class TableFull(ValueError):
+    pass
+
+
+class StringTable(object):
+    """放在共享内存中的只追加字典，把 service 、 tags 等取值映射为整数编号，0 表示 None 。
+
+    各进程在本地缓存已经见过的编号，只有遇到新取值时才加锁读写共享内存。
+    LOCK_TIMEOUT 秒内拿不到锁时，intern 按表已满处理，lookup 不加锁读取已经发布的取值。
+    """
+    def __init__(self, size=4 << 20):
+        self.shm = shared_memory.SharedMemory(create=True, size=size)
+        self.buf = self.shm.buf
+        TABLE_HEADER.pack_into(self.buf, 0, 0, TABLE_HEADER.size)
+        self.lock = multiprocessing.Lock()
+        self.ids = {}
+        self.values = [None]
+        self.synced_offset = TABLE_HEADER.size
+
+
+    def _sync(self):
+        """把其它进程新加入的取值读入本地缓存。"""
+        count, used = TABLE_HEADER.unpack_from(self.buf, 0)
+        offset = self.synced_offset
+        while len(self.values) <= count and offset < used:
+            length = ENTRY_HEADER.unpack_from(self.buf, offset)[0]
+            offset += ENTRY_HEADER.size
+            value = pickle.loads(self.buf[offset:offset + length])
+            offset += length
+            self.ids[value] = len(self.values)
+            self.values.append(value)
+        self.synced_offset = offset
+
+
+    def intern(self, value):
+        if value is None:
+            return 0
+        try:
+            return self.ids[value]
+        except KeyError:
+            pass
+        if not self.lock.acquire(timeout=LOCK_TIMEOUT):
+            raise TableFull("Timed out waiting for the string table lock of the shm queue.")
+        try:
+            self._sync()
+            if value in self.ids:
+                return self.ids[value]
+            raw = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+            count, used = TABLE_HEADER.unpack_from(self.buf, 0)
+            if used + ENTRY_HEADER.size + len(raw) > len(self.buf):
+                raise TableFull("String table of the shm queue is full.")
+            ENTRY_HEADER.pack_into(self.buf, used, len(raw))
+            self.buf[used + ENTRY_HEADER.size:used + ENTRY_HEADER.size + len(raw)] = raw
+            # 先写入内容，再发布新的 count
+            TABLE_HEADER.pack_into(self.buf, 0, count + 1, used + ENTRY_HEADER.size + len(raw))
+            self._sync()
+            return self.ids[value]
+        finally:
+            self.lock.release()
+
+
+    def lookup(self, index):
+        if index >= len(self.values):
+            if self.lock.acquire(timeout=LOCK_TIMEOUT):
+                try:
+                    self._sync()
+                finally:
+                    self.lock.release()
+            else:
+                # 新取值的内容先于 count 写入，不加锁也只会读到已经完整发布的取值
+                logger.warn("Timed out waiting for the string table lock of the shm queue, read it unlocked.")
+                self._sync()
+        return self.values[index]
+
+
+    def close(self, unlink=False):
+        self.buf = None
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+class ShmRing(object):
+    """定长记录的共享内存环形队列，接口与 multiprocessing.Queue 的 put/get 一致。
+
+    事件的字符串部分经 StringTable 转为编号，进程之间不需要 pickle 事件本身。
+    StringTable 写满后，带有新取值的事件改经 overflow （multiprocessing.Queue）传递，不丢弃。
+    """
+    def __init__(self, maxsize=100000, table_size=4 << 20):
+        self.capacity = maxsize
+        self.shm = shared_memory.SharedMemory(create=True, size=RECORDS_OFFSET + RECORD.size * maxsize)
+        self.buf = self.shm.buf
+        RING_HEADER.pack_into(self.buf, 0, 0, 0, 0)
+        self.lock = multiprocessing.Lock()
+        self.strings = StringTable(table_size)
+        self.overflow = multiprocessing.Queue(maxsize)
+        self.overflow_logged = False
+        self.owner = os.getpid()
+
+
+    def _encode(self, event):
+        flags = 0
+        if event.time is not None:
+            flags |= FLAG_TIME
+            if isinstance(event.time, int):
+                flags |= FLAG_TIME_INT
+        if event.metric is not None:
+            flags |= FLAG_METRIC
+            if isinstance(event.metric, int):
+                flags |= FLAG_METRIC_INT
+        return (flags,
+                self.strings.intern(event.service),
+                self.strings.intern(event.tags),
+                self.strings.intern(event.host),
+                float(event.time or 0.0),
+                float(event.metric or 0.0),
+                event.enqueued_at or 0.0,
+                event.ttl or 0.0)
+
+
+    def _decode(self, record):
+        flags, service, tags, host, the_time, metric, enqueued_at, ttl = record
+        if flags & FLAG_TIME:
+            the_time = int(the_time) if flags & FLAG_TIME_INT else the_time
+        else:
+            the_time = None
+        # metric 为 None 的事件照原样交给 Sender ，由它记录并丢弃
+        if flags & FLAG_METRIC:
+            metric = int(metric) if flags & FLAG_METRIC_INT else metric
+        else:
+            metric = None
+        return Event(service=self.strings.lookup(service),
+                     tags=self.strings.lookup(tags),
+                     time=the_time,
+                     metric=metric,
+                     host=self.strings.lookup(host),
+                     enqueued_at=enqueued_at or None,
+                     ttl=ttl or None)
+
+
+    def _wait(self, deadline, delay):
+        if deadline is not None and time.time() >= deadline:
+            return None
+        time.sleep(delay)
+        return min(delay * 2, POLL_MAX)
+
+
+    def put(self, event, block=True, timeout=None):
+        deadline = time.time() + timeout if block and timeout is not None else None
+        try:
+            record = self._encode(event)
+        except TableFull:
+            self._put_overflow(event, block, deadline)
+            return
+        delay = POLL_MIN
+        while True:
+            # 拿不到锁与队列已满一样处理，超时后不再等待
+            if not acquire(self.lock, block, deadline):
+                raise queue.Full
+            try:
+                head, tail, overflowed = RING_HEADER.unpack_from(self.buf, 0)
+                if head - tail < self.capacity:
+                    RECORD.pack_into(self.buf, RECORDS_OFFSET + RECORD.size * (head % self.capacity), *record)
+                    RING_HEADER.pack_into(self.buf, 0, head + 1, tail, overflowed)
+                    return
+            finally:
+                self.lock.release()
+            if not block:
+                raise queue.Full
+            delay = self._wait(deadline, delay)
+            if delay is None:
+                raise queue.Full
+
+
+    def _put_overflow(self, event, block, deadline):
+        if not self.overflow_logged:
+            logger.warn("String table of the shm queue is full, pass events with new service/tags/host "
+                        "through a pipe, consider a larger table_size_mb.")
+            self.overflow_logged = True
+        delay = POLL_MIN
+        while True:
+            if not acquire(self.lock, block, deadline):
+                raise queue.Full
+            # 放入管道与增加计数在同一把锁内，计数不会多于管道中的事件
+            try:
+                self.overflow.put_nowait(event)
+                head, tail, overflowed = RING_HEADER.unpack_from(self.buf, 0)
+                RING_HEADER.pack_into(self.buf, 0, head, tail, overflowed + 1)
+                return
+            except queue.Full:
+                pass
+            finally:
+                self.lock.release()
+            if not block:
+                raise queue.Full
+            delay = self._wait(deadline, delay)
+            if delay is None:
+                raise queue.Full
+
+
+    def _get_overflow(self):
+        try:
+            return self.overflow.get(timeout=OVERFLOW_WAIT)
+        except queue.Empty:
+            # 生产者在事件写入管道前退出
+            logger.warn("Lost an event passed through the overflow pipe of the shm queue.")
+            return None
+
+
+    def put_nowait(self, event):
+        self.put(event, block=False)
+
+
+    def get(self, block=True, timeout=None):
+        deadline = time.time() + timeout if block and timeout is not None else None
+        delay = POLL_MIN
+        while True:
+            if not acquire(self.lock, block, deadline):
+                raise queue.Empty
+            try:
+                head, tail, overflowed = RING_HEADER.unpack_from(self.buf, 0)
+                if head > tail:
+                    record = RECORD.unpack_from(self.buf, RECORDS_OFFSET + RECORD.size * (tail % self.capacity))
+                    RING_HEADER.pack_into(self.buf, 0, head, tail + 1, overflowed)
+                    break
+                if overflowed:
+                    RING_HEADER.pack_into(self.buf, 0, head, tail, overflowed - 1)
+            finally:
+                self.lock.release()
+            if overflowed:
+                event = self._get_overflow()
+                if event is not None:
+                    return event
+                continue
+            if not block:
+                raise queue.Empty
+            delay = self._wait(deadline, delay)
+            if delay is None:
+                raise queue.Empty
+        return self._decode(record)
+
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+
+    def qsize(self):
+        head, tail, overflowed = RING_HEADER.unpack_from(self.buf, 0)
+        return head - tail + overflowed
+
+
+    def close(self):
+        owner = self.owner == os.getpid()
+        self.buf = None
+        self.shm.close()
+        if owner:
+            self.shm.unlink()
+        self.strings.close(unlink=owner)
+        self.overflow.close()
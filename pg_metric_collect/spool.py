@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import os
+import mmap
+import struct
+import logging
+
+logger = logging.getLogger("pg_metric_collect")
+
+RECORD_HEADER = struct.Struct("!I")
+SEGMENT_SUFFIX = ".spool"
+OFFSET_FILE = "replay.offset"
+
+
+class EventSpool(object):
+    """发送失败的事件以长度前缀 + protobuf 编码追加写入本地分段文件，恢复后按写入顺序读出重放。
+
+    总大小超过 max_bytes 时从最旧的分段开始删除。
+    """
+    def __init__(self, directory, segment_size=16 << 20, max_bytes=1 << 30):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_bytes = max_bytes
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.segments = sorted(self._segment_seq(name) for name in os.listdir(directory)
+                               if name.endswith(SEGMENT_SUFFIX))
+        self.sizes = dict((seq, os.path.getsize(self._segment_path(seq))) for seq in self.segments)
+        self.writer = None
+        self.writer_seq = None
+        self.read_seq, self.read_offset = self._load_offset()
+        if self.segments:
+            logger.info("Found {} spooled segment(s) in {}.".format(len(self.segments), directory))
+
+
+    def _segment_seq(self, name):
+        return int(name[:-len(SEGMENT_SUFFIX)])
+
+
+    def _segment_path(self, seq):
+        return os.path.join(self.directory, "{:020d}{}".format(seq, SEGMENT_SUFFIX))
+
+
+    def _load_offset(self):
+        try:
+            with open(os.path.join(self.directory, OFFSET_FILE)) as f:
+                seq, offset = f.read().split()
+                return int(seq), int(offset)
+        except (IOError, OSError, ValueError):
+            return None, 0
+
+
+    def _save_offset(self):
+        path = os.path.join(self.directory, OFFSET_FILE)
+        with open(path + ".tmp", "w") as f:
+            f.write("{} {}".format(self.read_seq, self.read_offset))
+        os.rename(path + ".tmp", path)
+
+
+    def pending(self):
+        return bool(self.segments)
+
+
+    def _rotate(self):
+        self._close_writer()
+        self.writer_seq = (self.segments[-1] + 1) if self.segments else 1
+        self.writer = open(self._segment_path(self.writer_seq), "ab")
+        self.segments.append(self.writer_seq)
+        self.sizes[self.writer_seq] = 0
+
+
+    def _close_writer(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.writer = None
+        self.writer_seq = None
+
+
+    def _drop_segment(self, seq):
+        os.remove(self._segment_path(seq))
+        self.segments.remove(seq)
+        del self.sizes[seq]
+        if seq == self.writer_seq:
+            self._close_writer()
+        if seq == self.read_seq:
+            self.read_seq, self.read_offset = None, 0
+
+
+    def append(self, raw_events):
+        if self.writer is None or self.sizes[self.writer_seq] >= self.segment_size:
+            self._rotate()
+        data = b"".join(RECORD_HEADER.pack(len(raw)) + raw for raw in raw_events)
+        try:
+            self.writer.write(data)
+            self.writer.flush()
+        except:
+            # 写了一半的记录在 sizes 之外，读取时会被忽略；下次写入换新的分段
+            self._close_writer()
+            raise
+        self.sizes[self.writer_seq] += len(data)
+
+        while sum(self.sizes.values()) > self.max_bytes and len(self.segments) > 1:
+            logger.warn("Spool is over {} bytes, drop the oldest segment.".format(self.max_bytes))
+            self._drop_segment(self.segments[0])
+
+
+    def read(self, max_events):
+        """从最旧的分段读出最多 max_events 个事件，返回 (事件列表, 读完后的位置) 。"""
+        if not self.segments:
+            return [], None
+        seq = self.segments[0]
+        if seq == self.writer_seq:
+            # 只重放已经关闭的分段
+            self._close_writer()
+        if self.read_seq != seq:
+            self.read_seq, self.read_offset = seq, 0
+
+        size = self.sizes[seq]
+        offset = self.read_offset
+        events = []
+        if size > offset:
+            with open(self._segment_path(seq), "rb") as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    while offset + RECORD_HEADER.size <= size and len(events) < max_events:
+                        length = RECORD_HEADER.unpack_from(mm, offset)[0]
+                        if offset + RECORD_HEADER.size + length > size:
+                            logger.warn("Truncated record in spool segment {}, skip the rest.".format(seq))
+                            offset = size
+                            break
+                        offset += RECORD_HEADER.size
+                        events.append(mm[offset:offset + length])
+                        offset += length
+                finally:
+                    mm.close()
+        if not events and offset + RECORD_HEADER.size > size:
+            offset = size
+        return events, (seq, offset)
+
+
+    def commit(self, position):
+        """确认 read 返回的事件已经送达。"""
+        if position is None:
+            return
+        seq, offset = position
+        if seq not in self.sizes:
+            return
+        if offset >= self.sizes[seq]:
+            self._drop_segment(seq)
+        else:
+            self.read_seq, self.read_offset = seq, offset
+        self._save_offset()
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import re
+import heapq
+import logging
+
+import numpy
+
+from pg_metric_collect.counter_tool import SlotTable
+
+logger = logging.getLogger("pg_metric_collect")
+
+# 每个 (dbid, userid, queryid) 保存的累计计数器，与 PGAgent 中查询 pg_stat_statements 的列顺序一致
+COLUMNS = ("calls", "total_time", "rows", "blks_read", "blks_written")
+CALLS, TOTAL_TIME, ROWS, BLKS_READ, BLKS_WRITTEN = range(len(COLUMNS))
+
+# 按语句开头的关键字分类，依次匹配，都不匹配的归为 DEFAULT_CLASS
+QUERY_CLASSES = (("read", r"^select\b"),
+                 ("ddl", r"^(create|alter|drop|truncate|comment|grant|revoke)\b"),
+                 ("copy", r"^copy\b"),
+                 ("utility", r"^(vacuum|analyze|cluster|reindex|checkpoint|explain|set|reset|show|discard|"
+                             r"begin|start|commit|rollback|end|savepoint|release|prepare|execute|deallocate|"
+                             r"lock|listen|unlisten|notify|refresh)\b"))
+DEFAULT_CLASS = "write"
+
+
+class StatementsTracker(object):
+    """保存 pg_stat_statements 各条目上一次的累计值，计算每个周期的增量，取增量最大的条目。
+
+    累计值存放在 SlotTable 中，每个条目占一行，条目数超过 max_entries 时新条目不再跟踪。
+    本次快照中消失的条目（被 pg_stat_statements.max 淘汰）归还所占的行；
+    计数器回退（pg_stat_statements_reset()）或 epoch 变化（实例重启）时只记录本次的值，不计算增量。
+    """
+    def __init__(self, max_entries=20000):
+        self.max_entries = max_entries
+        # (dbid, userid, queryid) -> 行
+        self.table = SlotTable(len(COLUMNS), max_entries, "pg_stat_statements entries")
+        self.last_ts = None
+        self.epoch = None
+
+
+    def update(self, ts, rows, top_n=10, epoch=None):
+        """rows 为 (dbid, userid, queryid, calls, total_time, rows, blks_read, blks_written) 。
+
+        返回按增量总耗时、调用次数、读写块数各取前 top_n 的条目的并集，
+        每项为 ((dbid, userid, queryid), 每秒增量) ，每秒增量按 COLUMNS 的顺序。首次调用返回空列表。
+        """
+        if epoch != self.epoch:
+            self.table.clear()
+            self.epoch = epoch
+            self.last_ts = None
+        elapsed = ts - self.last_ts if self.last_ts is not None else None
+        self.last_ts = ts
+        self.table.next_generation()
+
+        keys = [(r[0], r[1], r[2]) for r in rows]
+        slots, known = self.table.slots(keys)
+        current = numpy.array([r[3:] for r in rows], dtype=float).reshape(len(rows), len(COLUMNS))
+        deltas = current - self.table.values[slots]
+        tracked = self.table.store(slots, current)
+        # 计数器回退说明条目被重置过，本次只作为新的基准
+        known &= tracked & (deltas >= 0).all(axis=1)
+        self.table.evict()
+
+        if not elapsed or elapsed <= 0:
+            return []
+        candidates = numpy.flatnonzero(known & (deltas[:, CALLS] > 0))
+        io = deltas[:, BLKS_READ] + deltas[:, BLKS_WRITTEN]
+        chosen = set()
+        for weights in (deltas[:, TOTAL_TIME], deltas[:, CALLS], io):
+            chosen.update(heapq.nlargest(top_n, candidates, key=weights.__getitem__))
+        return [(keys[i], tuple(float(v) / elapsed for v in deltas[i])) for i in sorted(chosen)]
+
+
+class QueryClassifier(object):
+    """缓存 queryid 到语句类别的映射，只有新出现的 queryid 才需要读取语句文本。
+
+    retain 丢弃不在 pg_stat_statements 中的 queryid ，缓存最多保存 max_entries 个。
+    """
+    def __init__(self, classes=QUERY_CLASSES, default=DEFAULT_CLASS, max_entries=20000):
+        self.classes = [(name, re.compile(pattern, re.IGNORECASE)) for name, pattern in classes]
+        self.names = [name for name, _ in classes] + [default]
+        self.default = default
+        self.max_entries = max_entries
+        self.cache = {}
+
+
+    def classify(self, query):
+        query = (query or "").lstrip()
+        for name, pattern in self.classes:
+            if pattern.match(query):
+                return name
+        return self.default
+
+
+    def missing(self, queryids):
+        """需要读取语句文本的 queryid ，缓存已满时多出的 queryid 按 default 计。"""
+        room = self.max_entries - len(self.cache)
+        rtn = set(queryid for queryid in queryids if queryid is not None and queryid not in self.cache)
+        return list(rtn)[:max(room, 0)]
+
+
+    def learn(self, rows):
+        """rows 为 (queryid, 语句文本) 。"""
+        for queryid, query in rows:
+            self.cache[queryid] = self.classify(query)
+
+
+    def retain(self, queryids):
+        for queryid in self.cache.keys() - set(queryids):
+            del self.cache[queryid]
+
+
+    def get(self, queryid):
+        return self.cache.get(queryid, self.default)
@@ -2,95 +2,436 @@
 # coding=utf-8
 
 import logging
+import math
+import concurrent.futures
 import time
+import traceback
 import queue
+import signal
+import functools
+import threading
+import collections
+
+from pg_metric_collect.event import Event
+from pg_metric_collect.instrument import Instruments
 
 logger = logging.getLogger("pg_metric_collect")
 
 WAIT_INTERVAL = 2
 
+# 有待重放的事件时 Sender 至少每隔这么多秒醒来一次
+REPLAY_INTERVAL = 0.1
+
+# 未在配置文件 [schedule] 中指定的指标使用的默认间隔（秒）
+DEFAULT_INTERVALS = {"boot_time": 3600,
+                     "cpu_cores": 3600,
+                     "database_size": 60,
+                     "relation_stats": 60}
+
 
 class Sender(object):
-    def __init__(self, mq, client, nouse):
+    def __init__(self, mq, client, batch_size=1, batch_linger=0, max_latency=1, exporter=None):
         self.q = mq
         self.client = client
+        # 可选的 prometheus_tool.PrometheusExporter ，与推送到 Riemann 的是同一批事件
+        self.exporter = exporter
+        # 与 client 共用，发送耗时也记录在这里
+        self.instruments = client.instruments
+        self.batch_size = max(batch_size, 1)
+        # 事件在 Sender 中停留的时间不超过 max_latency 秒
+        self.max_latency = max_latency
+        self.batch_linger = min(batch_linger, max_latency)
+        self.running = True
+        self.replaying = False
 
-    def __call__(self):
+    def stop(self, signum, frame):
+        logger.info("Sender is stopping, flush queued events ... ...")
+        # 不往队列中放结束标记：写入需要进程间共享的锁，刚被结束的采集进程可能还持有它，
+        # 进程退出时会卡在等待写入上。主循环的 get 最多等待 max_latency 秒，之后就会看到 running
+        self.running = False
+
+    def next_batch(self, timeout=None):
+        """最多等待 timeout 秒取第一个事件，之后在 deadline 之前最多取出 batch_size 个事件。"""
+        try:
+            first = self.q.get(timeout=timeout)
+        except queue.Empty:
+            return []
+        if first.enqueued_at is not None:
+            # 每批只取第一个（最早入队的）事件的排队耗时
+            self.instruments.record("queue_wait_seconds", time.time() - first.enqueued_at)
+
+        batch = [first]
+        deadline = time.time() + self.batch_linger
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.time()
+            try:
+                if remaining > 0:
+                    new_msg = self.q.get(timeout=remaining)
+                else:
+                    new_msg = self.q.get(block=False)
+            except queue.Empty:
+                break
+            batch.append(new_msg)
+        return batch
+
+    def flush(self):
+        batch = []
         while True:
-            new_msg = None
             try:
                 new_msg = self.q.get(block=False)
             except queue.Empty:
-                new_msg = None
+                break
+            batch.append(new_msg)
+            if len(batch) >= self.batch_size:
+                self.send(batch)
+                batch = []
+        if batch:
+            self.send(batch)
 
-            if new_msg is None:
-                time.sleep(WAIT_INTERVAL)
-                continue
+    def send(self, batch):
+        if self.exporter is not None:
+            self.exporter.update(batch)
+        self.client.send_batch(batch)
 
-            self.client.send(new_msg)
+    def __call__(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        if self.exporter is not None:
+            self.exporter.start()
+        while self.running:
+            timeout = REPLAY_INTERVAL if self.replaying else self.max_latency
+            if self.instruments.summary_due is not None:
+                until_summary = max(self.instruments.summary_due - time.time(), 0)
+                timeout = min(timeout, until_summary)
+            batch = self.next_batch(timeout)
+            if batch:
+                self.send(batch)
+            self.replaying = self.client.replay()
+            if self.instruments.due():
+                self.send(self.instruments.summary())
+        self.flush()
+        self.client.close()
+        if self.exporter is not None:
+            self.exporter.stop()
+        logger.info("Sender stopped.")
 
 
-class PGMonitor(object):
-    def __init__(self, mq, pgagent, full=True):
-        self.q = mq
-        self.agent = pgagent
-        self.fullmode = full
+class MetricJob(object):
+    """一个按自己的间隔执行的指标，执行时间点对齐到墙上时钟，不随执行耗时漂移。"""
+    def __init__(self, name, interval, agent, timeout=None):
+        self.name = name
+        self.interval = interval
+        self.agent = agent
+        self.func = getattr(agent, "metric_" + name)
+        # 同一个进程采集多个实例时，用各实例自己的 host 标记事件
+        self.host = getattr(agent, "host_tag", None)
+        self.timeout = timeout
+        self.next_due = time.time()
+        self.running = False
 
 
-    def put_metrics_into_queue(self, metrics):
-        for metric in metrics:
-            self.q.put(metric)
+    def reschedule(self, now):
+        """返回本次错过的 tick 数。"""
+        next_due = (math.floor(now / self.interval) + 1) * self.interval
+        skipped = max(int(round((next_due - self.next_due) / self.interval)) - 1, 0)
+        self.next_due = next_due
+        return skipped
 
 
-    def __call__(self):
-        while True:
-            if self.fullmode:
-                self.put_metrics_into_queue(self.agent.metric_database_size())
-                self.put_metrics_into_queue(self.agent.metric_database_connections())
-                self.put_metrics_into_queue(self.agent.metric_database_active_connections())
-                self.put_metrics_into_queue(self.agent.metric_new_connections_in_5sec())
-                self.put_metrics_into_queue(self.agent.metric_max_connection_in_use())
-                self.put_metrics_into_queue(self.agent.metric_qps())
-                self.put_metrics_into_queue(self.agent.metric_tps())
-                self.put_metrics_into_queue(self.agent.metric_handled_rows_per_second())
-                #self.put_metrics_into_queue(self.agent.metric_new_dirty_page_per_second())
-                #self.put_metrics_into_queue(self.agent.metric_write_dirty_page_per_second())
-                self.put_metrics_into_queue(self.agent.metric_long_query_5sec())
-                self.put_metrics_into_queue(self.agent.metric_long_transaction_5sec())
-                self.put_metrics_into_queue(self.agent.metric_long_idle_in_transaction_5sec())
-                self.put_metrics_into_queue(self.agent.metric_wait_session())
-                self.put_metrics_into_queue(self.agent.metric_dead_lock_number())
-                self.put_metrics_into_queue(self.agent.metric_udi_rows())
-                #self.put_metrics_into_queue(self.agent.metric_replication_lag())
-
-            self.put_metrics_into_queue(self.agent.metric_seq_idx_scan())
-            self.put_metrics_into_queue(self.agent.metric_index_hit_ratio())
-            self.put_metrics_into_queue(self.agent.metric_cache_hit_ratio())
-            self.put_metrics_into_queue(self.agent.metric_top10_long_query_in_db())
-            self.put_metrics_into_queue(self.agent.metric_top10_history_long_query_in_db())
-
-            time.sleep(WAIT_INTERVAL)
-
-
-class SysMonitor(object):
-    def __init__(self, mq, osagent, nouse):
+class TickGroup(object):
+    """一个 agent 在一次 tick 中到期的指标，全部完成后结束该 agent 的这次 tick 。"""
+    def __init__(self, agent, jobs, started):
+        self.agent = agent
+        self.started = started
+        self.min_interval = min(job.interval for job in jobs)
+        self.lock = threading.Lock()
+        self.pending = len(jobs)
+
+
+    def done(self):
+        """返回是否为最后一个完成的指标。"""
+        with self.lock:
+            self.pending -= 1
+            return self.pending == 0
+
+
+class Monitor(object):
+    METRICS = []
+
+    def __init__(self, mq, agents, intervals=None, workers=0, timeouts=None, metric_timeout=None,
+                 telemetry_interval=10, instrument_interval=60, stages=None):
         self.q = mq
-        self.agent = osagent
+        # 放入队列前依次经过的处理环节，例如 pipeline.DedupStage
+        self.stages = stages or []
+        self.instruments = Instruments(instrument_interval)
+        self.telemetry_interval = telemetry_interval
+        self.telemetry_due = time.time() + telemetry_interval
+        self.agents = agents
+        self.workers = workers
+        self.executor = None
+        # 每个 agent 同时占用的线程数不超过 agent_workers ，一个卡住的实例不会占满整个线程池；
+        # 超出的指标在 backlog 中排队，等该 agent 的指标完成时再提交
+        self.agent_workers = max(workers // max(len(agents), 1), 1)
+        self.dispatch_lock = threading.RLock()
+        self.backlog = collections.defaultdict(collections.deque)
+        self.in_flight = collections.Counter()
+        # 指标完成时唤醒主循环，重新计算下一次到期的时间
+        self.wakeup = threading.Event()
+        intervals = intervals or {}
+        timeouts = timeouts or {}
+        self.jobs = []
+        for agent in self.agents:
+            for name in self.metric_names():
+                interval = intervals.get(name, DEFAULT_INTERVALS.get(name, WAIT_INTERVAL))
+                self.jobs.append(MetricJob(name, interval, agent, timeouts.get(name, metric_timeout)))
+
+
+    def metric_names(self):
+        return self.METRICS
 
 
     def put_metrics_into_queue(self, metrics):
-        for metric in metrics:
-            self.q.put(metric)
+        for stage in self.stages:
+            metrics = stage.process(metrics)
+        if metrics:
+            self.q.put_many(metrics)
+
+
+    def flush_stages(self, now):
+        """到期的处理环节（例如 pipeline.WindowStage）输出的事件继续经过它之后的环节。"""
+        for i, stage in enumerate(self.stages):
+            if stage.next_flush is None or now < stage.next_flush:
+                continue
+            metrics = stage.flush(now)
+            for later in self.stages[i + 1:]:
+                metrics = later.process(metrics)
+            if metrics:
+                self.q.put_many(metrics)
+
+
+    def begin_tick(self, agents):
+        pass
+
+
+    def end_tick(self, agents):
+        pass
+
+
+    def is_available(self, agent):
+        return True
+
+
+    def run_job(self, job, deadline=None):
+        tags = (job.name,)
+        try:
+            started = time.time()
+            metrics = job.func()
+            finished = time.time()
+            self.instruments.record("metric_seconds", finished - started, tags, job.host)
+            self.instruments.incr("metric_rows", tags, job.host, len(metrics))
+            if deadline is not None and finished > deadline:
+                logger.warn("Metric {} took longer than {}s, drop its result.".format(job.name, job.timeout))
+                self.instruments.incr("metric_timeouts", tags, job.host)
+                return
+            if job.host is not None:
+                for metric in metrics:
+                    metric.host = job.host
+            self.put_metrics_into_queue(metrics)
+        except:
+            if not self.is_available(job.agent):
+                # 实例连接失败已经记录过日志
+                logger.debug("Metric {} skipped, its target is unavailable.".format(job.name))
+                return
+            logger.error("Metric {} failed.".format(job.name))
+            logger.error(traceback.format_exc())
+            self.instruments.incr("metric_errors", tags, job.host)
+
+
+    def submit_jobs(self, agent, jobs, group):
+        with self.dispatch_lock:
+            self.backlog[agent].extend((job, group) for job in jobs)
+            self._dispatch(agent)
+
+
+    def _dispatch(self, agent):
+        backlog = self.backlog[agent]
+        while backlog and self.in_flight[agent] < self.agent_workers:
+            job, group = backlog.popleft()
+            self.in_flight[agent] += 1
+            # 超时从提交时算起，在 backlog 中排队的时间不计入
+            deadline = time.time() + job.timeout if job.timeout else None
+            future = self.executor.submit(self.run_job, job, deadline)
+            future.add_done_callback(functools.partial(self._job_finished, job, group))
+
+
+    def _job_finished(self, job, group, future):
+        """在执行该指标的线程中调用。"""
+        with self.dispatch_lock:
+            self.in_flight[job.agent] -= 1
+            self._dispatch(job.agent)
+        try:
+            self.job_done(job, group)
+        except:
+            logger.error(traceback.format_exc())
+        self.wakeup.set()
+
+
+    def job_done(self, job, group):
+        """每个指标按自己完成的时间重新安排下一次执行，慢的指标只影响它自己的序列。"""
+        finished = time.time()
+        skipped = job.reschedule(finished)
+        job.running = False
+        if skipped > 0:
+            self.report_skipped(job, skipped)
+        if not group.done():
+            return
+        try:
+            self.end_tick([group.agent])
+        except:
+            logger.error("Ending the tick of {} failed.".format(self.__class__.__name__))
+            logger.error(traceback.format_exc())
+        cycle_tags = (self.__class__.__name__,)
+        host = getattr(group.agent, "host_tag", None)
+        self.instruments.record("cycle_seconds", finished - group.started, cycle_tags, host)
+        # 超出本次到期指标中最短间隔的部分
+        overrun = finished - group.started - group.min_interval
+        if overrun > 0:
+            self.instruments.record("cycle_overrun_seconds", overrun, cycle_tags, host)
+
+
+    def report_skipped(self, job, skipped):
+        logger.warn("Metric {} overran its {}s interval, skipped {} tick(s).".format(job.name, job.interval, skipped))
+        event = Event(service="skipped_ticks",
+                      tags=["pg_metric_collect", job.name],
+                      time=int(time.time()),
+                      metric=skipped)
+        if job.host is not None:
+            event.host = job.host
+        self.put_metrics_into_queue([event])
+
+
+    def run_tick(self, now, due):
+        """按 agent 分组开始本次 tick 。并发执行时只提交，不等待指标完成。"""
+        by_agent = collections.OrderedDict()
+        for job in due:
+            job.running = True
+            by_agent.setdefault(job.agent, []).append(job)
+        for agent, jobs in by_agent.items():
+            group = TickGroup(agent, jobs, now)
+            try:
+                self.begin_tick([agent])
+            except:
+                # 一次 tick 出错不应结束整个采集进程
+                logger.error("Tick of {} failed.".format(self.__class__.__name__))
+                logger.error(traceback.format_exc())
+                for job in jobs:
+                    self.job_done(job, group)
+                continue
+            if self.executor is None:
+                for job in jobs:
+                    self.run_job(job)
+                    self.job_done(job, group)
+            else:
+                self.submit_jobs(agent, jobs, group)
 
 
     def __call__(self):
+        if self.workers > 0:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
         while True:
-            self.put_metrics_into_queue(self.agent.metric_boot_time())
-            self.put_metrics_into_queue(self.agent.metric_average_load())
-            self.put_metrics_into_queue(self.agent.metric_cpu_cores())
-            self.put_metrics_into_queue(self.agent.metric_cpu_percent())
-            self.put_metrics_into_queue(self.agent.metric_memory())
-            self.put_metrics_into_queue(self.agent.metric_disk_usage())
-            self.put_metrics_into_queue(self.agent.metric_disk_io())
-
-            time.sleep(WAIT_INTERVAL)
+            now = time.time()
+            due = []
+            for job in self.jobs:
+                # 上一次超时仍未返回的指标不再重复提交
+                if job.next_due > now or job.running:
+                    continue
+                # 暂时连不上的实例直接跳过本次 tick ，不影响其它实例
+                if not self.is_available(job.agent):
+                    job.reschedule(now)
+                    continue
+                due.append(job)
+
+            if due:
+                self.run_tick(now, due)
+
+            if self.telemetry_interval and time.time() >= self.telemetry_due:
+                self.telemetry_due += self.telemetry_interval
+                self.put_metrics_into_queue(self.q.telemetry(self.__class__.__name__))
+            if self.instruments.due():
+                self.put_metrics_into_queue(self.instruments.summary())
+            self.flush_stages(time.time())
+
+            waiting = [job.next_due for job in self.jobs if not job.running]
+            if self.telemetry_interval:
+                waiting.append(self.telemetry_due)
+            if self.instruments.summary_due is not None:
+                waiting.append(self.instruments.summary_due)
+            waiting.extend(stage.next_flush for stage in self.stages if stage.next_flush is not None)
+            next_due = min(waiting) if waiting else time.time() + WAIT_INTERVAL
+            self.wakeup.wait(max(next_due - time.time(), 0))
+            self.wakeup.clear()
+
+
+class PGMonitor(Monitor):
+    FULL_METRICS = ["database_size",
+                    "database_connections",
+                    "database_active_connections",
+                    "new_connections_in_5sec",
+                    "max_connection_in_use",
+                    "qps",
+                    "tps",
+                    "handled_rows_per_second",
+                    #"new_dirty_page_per_second",
+                    #"write_dirty_page_per_second",
+                    "long_query_5sec",
+                    "long_transaction_5sec",
+                    "long_idle_in_transaction_5sec",
+                    "wait_session",
+                    "dead_lock_number",
+                    "udi_rows"]
+                    #"replication_lag"
+
+    DB_METRICS = ["seq_idx_scan",
+                  "index_hit_ratio",
+                  "cache_hit_ratio",
+                  "top10_long_query_in_db",
+                  "top_statements",
+                  "relation_stats"]
+
+    def __init__(self, mq, pgagents, full=True, **kwargs):
+        self.fullmode = full
+        super(PGMonitor, self).__init__(mq, pgagents, **kwargs)
+
+
+    def metric_names(self):
+        if self.fullmode:
+            return self.FULL_METRICS + self.DB_METRICS
+        return self.DB_METRICS
+
+
+    def begin_tick(self, agents):
+        for agent in agents:
+            agent.begin_cycle()
+
+
+    def end_tick(self, agents):
+        for agent in agents:
+            agent.end_cycle()
+
+
+    def is_available(self, agent):
+        return agent.available()
+
+
+class SysMonitor(Monitor):
+    METRICS = ["boot_time",
+               "average_load",
+               "cpu_cores",
+               "cpu_percent",
+               "memory",
+               "disk_usage",
+               "disk_io"]
+
+
+    def begin_tick(self, agents):
+        for agent in agents:
+            agent.begin_cycle()
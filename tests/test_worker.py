@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+import time
+import threading
+import unittest
+
+from pg_metric_collect.worker import Monitor
+
+
+class FakeQueue(object):
+    def __init__(self):
+        self.events = []
+
+
+    def put_many(self, events):
+        self.events.extend(events)
+
+
+    def telemetry(self, source):
+        return []
+
+
+class FakeAgent(object):
+    """metric_fast 立即返回，metric_slow 等待 release 或 slow_seconds 秒；hung 时所有指标都等待。"""
+    def __init__(self, host_tag, slow_seconds=0, hung=False):
+        self.host_tag = host_tag
+        self.slow_seconds = slow_seconds
+        self.hung = hung
+        self.release = threading.Event()
+        self.calls = {}
+
+
+    def _run(self, name, slow):
+        self.calls.setdefault(name, []).append(time.time())
+        if slow or self.hung:
+            self.release.wait(self.slow_seconds)
+        return []
+
+
+    def metric_fast(self):
+        return self._run("fast", False)
+
+
+    def metric_slow(self):
+        return self._run("slow", True)
+
+
+    def metric_rows(self):
+        return self._run("rows", False)
+
+
+    def metric_sizes(self):
+        return self._run("sizes", False)
+
+
+def start_monitor(agents, metrics, interval=0.2, workers=4):
+    class TestMonitor(Monitor):
+        METRICS = metrics
+
+    monitor = TestMonitor(FakeQueue(), agents, intervals=dict((name, interval) for name in metrics),
+                          workers=workers, telemetry_interval=0, instrument_interval=0)
+    thread = threading.Thread(target=monitor, name="TestMonitor")
+    thread.daemon = True
+    thread.start()
+    return monitor
+
+
+class MonitorSchedulingTest(unittest.TestCase):
+    def test_slow_metric_does_not_delay_others(self):
+        agent = FakeAgent("a", slow_seconds=1.5)
+        start_monitor([agent], ["fast", "slow"])
+        time.sleep(1.2)
+        agent.release.set()
+        self.assertEqual(len(agent.calls["slow"]), 1)
+        # 间隔 0.2 秒，慢指标没有结束时快指标照常执行
+        self.assertGreaterEqual(len(agent.calls["fast"]), 4)
+
+
+    def test_hung_target_does_not_delay_other_targets(self):
+        hung = FakeAgent("hung", slow_seconds=3, hung=True)
+        healthy = FakeAgent("healthy")
+        # 卡住的实例的指标比线程池的线程还多
+        start_monitor([hung, healthy], ["fast", "slow", "rows", "sizes"], workers=4)
+        time.sleep(1.2)
+        hung.release.set()
+        for name in ("fast", "slow", "rows", "sizes"):
+            self.assertGreaterEqual(len(healthy.calls[name]), 4, name)
+        # 卡住的实例最多占用一半的线程，其余指标排队等待
+        self.assertEqual(sum(len(calls) for calls in hung.calls.values()), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()